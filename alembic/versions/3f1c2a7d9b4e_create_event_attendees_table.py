@@ -0,0 +1,61 @@
+"""create event_attendees table; backfill from events.attendees
+
+Revision ID: 3f1c2a7d9b4e
+Revises: eae9bd4b43fd
+Create Date: 2017-11-20 10:12:03.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b4e'
+down_revision = 'eae9bd4b43fd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'event_attendees',
+        sa.Column('event_id', sa.BigInteger,
+                  sa.ForeignKey('events.id', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('user_id', sa.BigInteger,
+                  sa.ForeignKey('users.id', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False,
+                  server_default=sa.func.now())
+    )
+    op.create_index(
+        'ix_event_attendees_user_id_event_id',
+        'event_attendees', ['user_id', 'event_id'])
+
+    # Copy RSVPs out of the JSON lists, skipping ids that are not
+    # (or no longer) users.
+    op.execute("""
+        INSERT INTO event_attendees (event_id, user_id)
+        SELECT e.id, a.user_id::bigint
+        FROM events e,
+             json_array_elements_text(e.attendees) AS a(user_id)
+        WHERE json_typeof(e.attendees) = 'array'
+          AND a.user_id ~ '^[0-9]+$'
+          AND EXISTS (SELECT 1 FROM users u WHERE u.id = a.user_id::bigint)
+        ON CONFLICT DO NOTHING
+    """)
+
+    op.drop_column('events', 'attendees')
+
+
+def downgrade():
+    op.add_column('events', sa.Column('attendees', sa.types.JSON))
+    op.execute("""
+        UPDATE events e
+        SET attendees = a.user_ids
+        FROM (SELECT event_id, json_agg(user_id ORDER BY created_at) AS user_ids
+              FROM event_attendees
+              GROUP BY event_id) a
+        WHERE a.event_id = e.id
+    """)
+    op.drop_table('event_attendees')
@@ -0,0 +1,39 @@
+"""add spatial and temporal indexes to events
+
+Revision ID: 8a4d6e2f1c37
+Revises: 3f1c2a7d9b4e
+Create Date: 2017-11-24 14:31:47.502913
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6e2f1c37'
+down_revision = '3f1c2a7d9b4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Tables stood up by create_all may already have geoalchemy2's
+    # automatic index under this name.
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS idx_events_location '
+        'ON events USING gist (location)')
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS ix_events_listed_location '
+        'ON events USING gist (location) '
+        'WHERE category_id IS NOT NULL')
+    op.create_index('ix_events_start_time', 'events', ['start_time'])
+    op.create_index('ix_events_end_time', 'events', ['end_time'])
+    op.create_index('ix_events_category_id', 'events', ['category_id'])
+    op.execute('ANALYZE events')
+
+
+def downgrade():
+    op.drop_index('ix_events_category_id', table_name='events')
+    op.drop_index('ix_events_end_time', table_name='events')
+    op.drop_index('ix_events_start_time', table_name='events')
+    op.drop_index('ix_events_listed_location', table_name='events')
+    # idx_events_location is left in place, see upgrade().
@@ -0,0 +1,47 @@
+"""add unique index on users login
+
+Revision ID: a9c3e5f7b210
+Revises: f2a6c8d4e913
+Create Date: 2017-12-05 10:41:27.113902
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e5f7b210'
+down_revision = 'f2a6c8d4e913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Concurrent first logins could create the same user twice. Keep
+    # the oldest row, moving the RSVPs of any others onto it.
+    op.execute("""
+        CREATE TEMPORARY TABLE duplicate_users ON COMMIT DROP AS
+        SELECT id, first_value(id) OVER (
+                   PARTITION BY login_service, login_uid ORDER BY id
+               ) AS keep_id
+        FROM users
+        WHERE login_service IS NOT NULL AND login_uid IS NOT NULL
+    """)
+    op.execute("""
+        INSERT INTO event_attendees (event_id, user_id, created_at)
+        SELECT a.event_id, d.keep_id, a.created_at
+        FROM event_attendees a
+        JOIN duplicate_users d ON d.id = a.user_id AND d.id <> d.keep_id
+        ON CONFLICT DO NOTHING
+    """)
+    op.execute("""
+        DELETE FROM users
+        USING duplicate_users d
+        WHERE users.id = d.id AND d.id <> d.keep_id
+    """)
+    op.create_index(
+        'ux_users_login', 'users', ['login_service', 'login_uid'],
+        unique=True)
+
+
+def downgrade():
+    op.drop_index('ux_users_login', table_name='users')
@@ -0,0 +1,32 @@
+"""create venues table
+
+Revision ID: b4d8f0a2c635
+Revises: a9c3e5f7b210
+Create Date: 2017-12-07 14:22:05.518317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4d8f0a2c635'
+down_revision = 'a9c3e5f7b210'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'venues',
+        sa.Column('id', sa.String(32), primary_key=True),
+        sa.Column('latitude', sa.Float(), nullable=False),
+        sa.Column('longitude', sa.Float(), nullable=False),
+        sa.Column(
+            'fetched_at', sa.DateTime(), nullable=False,
+            server_default=sa.func.now())
+    )
+
+
+def downgrade():
+    op.drop_table('venues')
@@ -0,0 +1,32 @@
+"""add latitude and longitude columns to events
+
+Revision ID: c5e8b1f04a92
+Revises: 8a4d6e2f1c37
+Create Date: 2017-11-27 09:05:12.640381
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8b1f04a92'
+down_revision = '8a4d6e2f1c37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('events', sa.Column('latitude', sa.Float()))
+    op.add_column('events', sa.Column('longitude', sa.Float()))
+    op.execute("""
+        UPDATE events
+        SET latitude = ST_Y(location::geometry),
+            longitude = ST_X(location::geometry)
+        WHERE location IS NOT NULL
+    """)
+
+
+def downgrade():
+    op.drop_column('events', 'longitude')
+    op.drop_column('events', 'latitude')
@@ -0,0 +1,28 @@
+"""drop events listed location index
+
+Revision ID: c8e2a4f6b013
+Revises: e1f3a5c7d924
+Create Date: 2017-12-11 09:47:12.304158
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e2a4f6b013'
+down_revision = 'e1f3a5c7d924'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Duplicates idx_events_location for nearly every row, at the cost
+    # of a second GiST update on every write.
+    op.drop_index('ix_events_listed_location', table_name='events')
+
+
+def downgrade():
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS ix_events_listed_location '
+        'ON events USING gist (location) '
+        'WHERE category_id IS NOT NULL')
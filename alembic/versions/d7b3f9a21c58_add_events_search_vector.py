@@ -0,0 +1,39 @@
+"""add full-text search vector to events
+
+Revision ID: d7b3f9a21c58
+Revises: c5e8b1f04a92
+Create Date: 2017-11-29 20:41:37.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b3f9a21c58'
+down_revision = 'c5e8b1f04a92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('events', sa.Column('search_vector', TSVECTOR()))
+
+    # Same document as beluga.models.search_document().
+    op.execute("""
+        UPDATE events
+        SET search_vector =
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(description_text, '')), 'B')
+    """)
+
+    op.create_index(
+        'ix_events_search_vector', 'events', ['search_vector'],
+        postgresql_using='gin')
+    op.execute('ANALYZE events')
+
+
+def downgrade():
+    op.drop_index('ix_events_search_vector', table_name='events')
+    op.drop_column('events', 'search_vector')
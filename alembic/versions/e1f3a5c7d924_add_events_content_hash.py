@@ -0,0 +1,25 @@
+"""add content hash to events
+
+Revision ID: e1f3a5c7d924
+Revises: b4d8f0a2c635
+Create Date: 2017-12-08 11:03:44.920516
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f3a5c7d924'
+down_revision = 'b4d8f0a2c635'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Left empty; each event is rewritten once, on its next load.
+    op.add_column('events', sa.Column('content_hash', sa.String(40)))
+
+
+def downgrade():
+    op.drop_column('events', 'content_hash')
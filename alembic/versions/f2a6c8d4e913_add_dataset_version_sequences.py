@@ -0,0 +1,26 @@
+"""add dataset version sequences
+
+Revision ID: f2a6c8d4e913
+Revises: d7b3f9a21c58
+Create Date: 2017-12-02 15:12:48.902317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a6c8d4e913'
+down_revision = 'd7b3f9a21c58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('events_version_seq')))
+    op.execute(sa.schema.CreateSequence(sa.Sequence('categories_version_seq')))
+
+
+def downgrade():
+    op.execute(sa.schema.DropSequence(sa.Sequence('categories_version_seq')))
+    op.execute(sa.schema.DropSequence(sa.Sequence('events_version_seq')))
@@ -0,0 +1,31 @@
+"""add events upcoming index
+
+Revision ID: f5b7d9e1a346
+Revises: c8e2a4f6b013
+Create Date: 2017-12-12 10:18:52.601347
+
+"""
+import datetime as dt
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5b7d9e1a346'
+down_revision = 'c8e2a4f6b013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built on today's date; clear_old_events rebuilds it daily.
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS ix_events_upcoming '
+        'ON events (start_time, id) '
+        "WHERE category_id IS NOT NULL AND start_time >= '{}'::timestamp"
+        .format(dt.date.today().isoformat()))
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS ix_events_upcoming_new')
+    op.execute('DROP INDEX IF EXISTS ix_events_upcoming')
@@ -1,10 +1,11 @@
+import asyncio
 from contextlib import contextmanager
 import logging
 
 from sanic import Sanic
-from sqlalchemy import create_engine
 
-from beluga import config
+from beluga import aiodb, compression, config, ratelimit
+from beluga.certs import google_certs
 from beluga.routes import api
 from beluga.models import db_setup
 
@@ -17,20 +18,27 @@ app.config.from_object(config)
 logging.basicConfig(level=logging.INFO)
 app.logger = logging.getLogger(__name__)
 
-# Global database engine.
-db_engine = create_engine(
-    app.config.DATABASE_URL,
-    convert_unicode=True)
-
 @app.middleware("request")
 async def log_uri(request):
     # Simple middleware to log the URI endpoint that was called
     app.logger.info("URI called: {0}".format(request.url))
 
 
+app.register_middleware(ratelimit.limit_ip, 'request')
+app.register_middleware(compression.compress_response, 'response')
+
+
 @app.listener('before_server_start')
 async def setup_db(app, loop):
     db_setup()
+    await aiodb.create_pool(loop)
+    # In the background, so startup doesn't wait on Google.
+    asyncio.ensure_future(google_certs.warm(), loop=loop)
+
+
+@app.listener('after_server_stop')
+async def teardown_db(app, loop):
+    await aiodb.close_pool()
 
 
 app.blueprint(api)
@@ -0,0 +1,129 @@
+"""asyncio-native database access for the request path.
+
+Queries are still built with the SQLAlchemy models in `beluga.models`
+(including the geoalchemy2 geography functions); they are compiled to
+PostgreSQL and executed on an asyncpg pool, so a slow query only
+suspends the handler that issued it instead of the whole event loop.
+"""
+import logging
+import re
+
+import asyncpg
+from sqlalchemy.dialects.postgresql.base import PGDialect
+
+from beluga import config
+from beluga.models import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# Compile with numbered parameters (:1, :2, ...), rewritten to $1, $2.
+# Casts are always followed by a type name, so "::2" can only be a
+# slice separator followed by a parameter, as in "[:1::2]".
+_dialect = PGDialect(paramstyle='numeric')
+_numeric_param = re.compile(r'(?<!\w):(\d+)')
+
+# One asyncpg pool per worker process, created when the server starts.
+_pool = None
+
+
+async def create_pool(loop=None):
+    """Opens the process-wide asyncpg pool."""
+    global _pool
+    logger.info('Opening async database pool.')
+    _pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=config.ASYNC_DB_POOL_MIN,
+        max_size=config.ASYNC_DB_POOL_MAX,
+        max_inactive_connection_lifetime=config.DB_POOL_RECYCLE,
+        loop=loop)
+    return _pool
+
+
+async def close_pool():
+    """Closes the process-wide asyncpg pool."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool():
+    assert _pool is not None, 'async database pool is not open'
+    return _pool
+
+
+def compile_query(query):
+    """Compiles a SQLAlchemy statement into asyncpg SQL and arguments.
+
+    Args:
+        query: A SQLAlchemy Core statement (select, insert, ...).
+
+    Returns:
+        A tuple (sql, args) ready for asyncpg.
+    """
+    compiled = query.compile(dialect=_dialect)
+    sql = _numeric_param.sub(r'$\1', str(compiled))
+
+    params = compiled.params
+    processors = compiled._bind_processors
+    args = []
+    for name in compiled.positiontup:
+        value = params[name]
+        processor = processors.get(name)
+        args.append(processor(value) if processor else value)
+
+    return sql, args
+
+
+def _executor(conn):
+    return conn if conn is not None else get_pool()
+
+
+async def fetch(query, conn=None):
+    """Returns all rows for `query` as asyncpg Records."""
+    sql, args = compile_query(query)
+    return await _executor(conn).fetch(sql, *args)
+
+
+async def fetchrow(query, conn=None):
+    """Returns the first row for `query`, or None."""
+    sql, args = compile_query(query)
+    return await _executor(conn).fetchrow(sql, *args)
+
+
+async def fetchval(query, conn=None):
+    """Returns the first column of the first row for `query`."""
+    sql, args = compile_query(query)
+    return await _executor(conn).fetchval(sql, *args)
+
+
+async def execute(query, conn=None):
+    """Executes `query` and returns the status string."""
+    sql, args = compile_query(query)
+    return await _executor(conn).execute(sql, *args)
+
+
+def cursor(query, conn, prefetch=50):
+    """Iterates `query` through a server-side cursor on `conn`, which
+    must be inside a transaction.
+
+    Example:
+
+        async with conn.transaction():
+            async for row in aiodb.cursor(query, conn):
+                ...
+    """
+    sql, args = compile_query(query)
+    return conn.cursor(sql, *args, prefetch=prefetch)
+
+
+def pool_stats():
+    """Returns the size of the async pool."""
+    if _pool is None:
+        return {}
+    return {
+        'size': len(_pool._holders),
+        'idle': _pool._queue.qsize(),
+        'max_size': config.ASYNC_DB_POOL_MAX,
+    }
+
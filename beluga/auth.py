@@ -1,12 +1,16 @@
 import base64
+from collections import OrderedDict, namedtuple
+import time
+import uuid
 
-from beluga import config
-from beluga.models import session_scope, User
+from beluga import aiodb, config, queries, ratelimit
+from beluga.certs import google_certs
+from beluga.executor import run_blocking
+from beluga.revocation import revocations
 
 from functools import wraps
 
-from google.oauth2 import id_token
-from google.auth.transport import requests as grequests
+from google.auth import jwt
 
 from itsdangerous import Signer, BadSignature
 
@@ -18,9 +22,90 @@ import ujson
 state_signer = Signer(config.SECRET_BASE)
 
 BEARER_TOKEN_TYPE = 'bearer'
+ACCESS_TOKEN_TYPE = 'access'
+CURSOR_TOKEN_TYPE = 'cursor'
 GOOGLE_TOKEN_TYPE = 'google'
 
 GOOGLE_SERVICE_ID = "google"
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# Bumped whenever the claims in an access token change shape.
+ACCESS_TOKEN_VERSION = 2
+
+# The authorized user handed to route handlers.
+AuthUser = namedtuple('AuthUser', ['id', 'given_name', 'surname', 'avatar'])
+
+
+class TokenCache:
+    """Legacy bearer tokens and the users they belong to, so repeat
+    requests skip the user query.
+
+    Entries expire after `ttl` seconds, which bounds how long another
+    process's change to a user can go unseen. Changes made in this
+    process call invalidate_user(). Only used from the event loop.
+
+    Args:
+        max_entries (int): Tokens kept, least recently used evicted.
+        ttl (int): Seconds an entry may be served for.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tokens = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, token):
+        item = self._entries.get(token)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                self._discard(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return item[0]
+
+    def set(self, token, user):
+        self._discard(token)
+        self._entries[token] = (user, time.monotonic() + self.ttl)
+        self._tokens.setdefault(user.id, set()).add(token)
+        while len(self._entries) > self.max_entries:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, token):
+        item = self._entries.pop(token, None)
+        if item is not None:
+            tokens = self._tokens.get(item[0].id, set())
+            tokens.discard(token)
+            if not tokens:
+                self._tokens.pop(item[0].id, None)
+
+    def invalidate_user(self, user_id):
+        """Drops every cached token of a changed or deleted user."""
+        for token in self._tokens.pop(user_id, set()):
+            self._entries.pop(token, None)
+        self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._tokens.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+token_cache = TokenCache(config.AUTH_CACHE_MAX_ENTRIES, config.AUTH_CACHE_TTL)
 
 def authorized():
     """A decorator for authorization.
@@ -39,7 +124,9 @@ def authorized():
         @wraps(f)
         async def decorated_function(request, *args, **kwargs):
             # Check for authorization.
-            user = check_request_for_auth_status(request)
+            user = await check_request_for_auth_status(request)
+            if isinstance(user, AuthUser):
+                await ratelimit.limit_user(user.id)
             if user:
                 response = await f(request, user, *args, **kwargs)
                 return response
@@ -50,7 +137,7 @@ def authorized():
         return decorated_function
     return decorator
 
-def check_request_for_auth_status(request):
+async def check_request_for_auth_status(request):
     """Checks a request to see if the user is authenticated.
     This would likely check for a Bearer token.
 
@@ -82,63 +169,110 @@ def check_request_for_auth_status(request):
 
     # Validate signature
     try:
-        user_id = unsign(BEARER_TOKEN_TYPE, bearer_token)
-    except BadSignature as e:
+        token_type, value = unsign_typed(bearer_token)
+    except (BadSignature, KeyError, TypeError, ValueError):
         return False
 
+    if token_type == ACCESS_TOKEN_TYPE:
+        # Everything needed is in the token itself.
+        await revocations.sync()
+        user = read_access_token(value)
+        if user is not None:
+            request['auth_claims'] = value
+        return user
+
+    if token_type != BEARER_TOKEN_TYPE:
+        return False
+
+    # Legacy tokens carry only a user id. A token seen recently
+    # needs no query.
+    user = token_cache.get(bearer_token)
+    if user is not None:
+        return user
+
     # Validate user exists
-    with session_scope() as db_session:
-        query = db_session.query(User).filter(User.id == user_id)
-        exists = db_session.query(query.exists()).scalar()
-        if not exists:
-            return None
-        else:
-            user = query.first()
-            db_session.expunge(user)
-            return user
+    row = await aiodb.fetchrow(queries.user_select(value))
+    if row is None:
+        return None
+    user = AuthUser(**dict(row))
+    token_cache.set(bearer_token, user)
+    return user
 
 async def google(token):
     """Create a session using a Google OAuth2 token"""
+    # Cached; only the first login of a process waits on Google.
+    certs = await google_certs.get()
     try:
-        idinfo = id_token.verify_oauth2_token(token, grequests.Request(), config.GOOGLE_CLIENT_ID)
-
-        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-            raise ValueError('bad issuer in token')
+        # Signature checks are pure Python, keep them off the loop.
+        idinfo = await run_blocking(
+            'auth', verify_google_token, token, certs)
     except (ValueError, KeyError):
         # Bad token! Bail out!
         return None
 
-    uid = idinfo['sub']
-    given_name = idinfo['given_name']
-    surname = idinfo['family_name']
-    avatar = idinfo['picture']
-
-    with session_scope() as db_session:
-        query = db_session.query(User).filter(
-            User.login_service == GOOGLE_SERVICE_ID,
-            User.login_uid == uid
-        )
-
-        if db_session.query(query.exists()).scalar():
-            user = query.first()
-        else:
-            user = User(
-                given_name=given_name,
-                surname=surname,
-                avatar=avatar,
-                login_service=GOOGLE_SERVICE_ID,
-                login_uid=uid,
-                login_info=idinfo
-            )
-            db_session.add(user)
-            db_session.commit()
-
-        authenticated_user_id = user.id
-
-    # sign a bearer token
-    # We should *NOT* use this long term because this scheme
-    # only allows us to single a single bearer token value per user
-    return sign(BEARER_TOKEN_TYPE, authenticated_user_id)
+    row = await aiodb.fetchrow(queries.login_upsert(
+        GOOGLE_SERVICE_ID, idinfo['sub'], idinfo['given_name'], idinfo['family_name'],
+        idinfo.get('picture'), idinfo))
+    user = AuthUser(**dict(row))
+    token_cache.invalidate_user(user.id)
+
+    return issue_access_token(user)
+
+def verify_google_token(token, certs):
+    """Verifies a Google ID token against Google's certificates.
+    Returns its claims.
+
+    Raises:
+        ValueError: The token is malformed, expired, badly signed or
+            not issued by Google for this app.
+    """
+    idinfo = jwt.decode(token, certs=certs, audience=config.GOOGLE_CLIENT_ID)
+    if idinfo['iss'] not in GOOGLE_ISSUERS:
+        raise ValueError('bad issuer in token')
+    return idinfo
+
+def issue_access_token(user):
+    """Signs a new expiring access token carrying an AuthUser."""
+    now = int(time.time())
+    return sign(ACCESS_TOKEN_TYPE, {
+        'v': ACCESS_TOKEN_VERSION,
+        'jti': uuid.uuid4().hex,
+        'iat': now,
+        'exp': now + config.ACCESS_TOKEN_TTL,
+        'sub': user.id,
+        'given_name': user.given_name,
+        'surname': user.surname,
+        'avatar': user.avatar
+    })
+
+def read_access_token(claims):
+    """The AuthUser of verified access token claims, or None if the
+    token has expired, been revoked or is of an unknown version.
+    """
+    try:
+        if claims['v'] != ACCESS_TOKEN_VERSION:
+            return None
+        if claims['exp'] <= time.time() or revocations.is_revoked(claims['jti']):
+            return None
+        return AuthUser(
+            claims['sub'], claims['given_name'], claims['surname'],
+            claims['avatar'])
+    except (KeyError, TypeError):
+        return None
+
+async def rotate(user, claims):
+    """Revokes the presented access token, if any, and issues a new one
+    with the user's current profile.
+
+    Returns None if the user no longer exists.
+    """
+    if claims is not None:
+        await revocations.revoke(claims['jti'], claims['exp'])
+
+    row = await aiodb.fetchrow(queries.user_select(user.id))
+    if row is None:
+        return None
+    return issue_access_token(AuthUser(**dict(row)))
 
 def sign(sig_type, unsigned):
     """Sign a typed value"""
@@ -150,13 +284,18 @@ def sign(sig_type, unsigned):
     signature = state_signer.sign(raw_bytes)
     return base64.b64encode(signature).decode('ascii')
 
-def unsign(sig_type, signed):
-    """Verify a signature and type. Returns signed value"""
+def unsign_typed(signed):
+    """Verify a signature. Returns the signed type and value"""
     signed_decoded = base64.b64decode(bytes(signed, 'ascii'))
     raw_bytes = state_signer.unsign(signed_decoded)
     state = ujson.loads(raw_bytes.decode('utf-8'))
+    return state['type'], state['val']
+
+def unsign(sig_type, signed):
+    """Verify a signature and type. Returns signed value"""
+    state_type, value = unsign_typed(signed)
 
-    if state['type'] != sig_type:
+    if state_type != sig_type:
         raise Exception("signature type mismatch")
 
-    return state['val']
+    return value
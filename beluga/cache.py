@@ -0,0 +1,257 @@
+"""Response cache for GET /events, invalidated by map tile.
+
+The map is divided into a grid of tiles `config.CACHE_TILE_DEGREES`
+wide. Every tile has a generation counter which the worker bumps
+whenever it loads or deletes an event inside it. A cached response
+remembers the generations of all tiles its search circle covers and is
+only served while none of them has moved on. Searches covering too many
+tiles to track watch a single counter that every change bumps.
+
+Two backends are available: an in-process LRU with TTL, suitable for a
+single process, and Redis, which is shared by every gunicorn worker and
+sees the celery worker's invalidations.
+"""
+from collections import OrderedDict
+import math
+import threading
+import time
+
+import ujson
+
+from beluga import config
+from beluga.executor import run_blocking
+
+METERS_PER_DEGREE = 111320.0
+
+# Generation key bumped when a change can't be pinned to tiles.
+GLOBAL_KEY = 'gen:*'
+# Generation key bumped by every change, for searches too wide to
+# follow tile by tile.
+WIDE_KEY = 'gen:wide'
+
+
+def tile_of(lat, lon):
+    """The (row, column) of the tile containing a point."""
+    size = config.CACHE_TILE_DEGREES
+    return int(math.floor(lat / size)), int(math.floor(lon / size))
+
+
+def tiles_covering(lat, lon, dist):
+    """The tiles overlapping the bounding box of a search circle of
+    `dist` metres, or None if there are too many to track.
+    """
+    dlat = dist / METERS_PER_DEGREE
+    dlon = dist / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    south, west = tile_of(lat - dlat, lon - dlon)
+    north, east = tile_of(lat + dlat, lon + dlon)
+
+    if (north - south + 1) * (east - west + 1) > config.CACHE_MAX_TILES:
+        return None
+
+    return [(row, col)
+            for row in range(south, north + 1)
+            for col in range(west, east + 1)]
+
+
+def generation_keys(tiles):
+    """Counter keys for a set of tiles; None means 'everywhere'."""
+    if tiles is None:
+        return [GLOBAL_KEY, WIDE_KEY]
+    return [GLOBAL_KEY] + [
+        'gen:{}:{}'.format(row, col) for row, col in sorted(tiles)]
+
+
+def quantize(value):
+    """Snaps a coordinate so that nearby requests share a cache entry."""
+    return round(value, config.CACHE_COORD_PRECISION)
+
+
+class MemoryBackend:
+    """An in-process LRU store with per-entry expiry."""
+
+    blocking = False
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_counters(self, keys):
+        with self._lock:
+            return [self._counters.get(k, 0) for k in keys]
+
+    def incr_counters(self, keys):
+        with self._lock:
+            for k in keys:
+                self._counters[k] = self._counters.get(k, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """A store shared between processes. Eviction beyond the TTL is left
+    to the Redis maxmemory policy (allkeys-lru is recommended).
+    """
+
+    blocking = True
+
+    def __init__(self, url, prefix='beluga:cache:'):
+        import redis
+        self.prefix = prefix
+        self._client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self.prefix + key, value, ex=ttl)
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    def get_counters(self, keys):
+        values = self._client.mget([self.prefix + k for k in keys])
+        return [int(v) if v is not None else 0 for v in values]
+
+    def incr_counters(self, keys):
+        pipe = self._client.pipeline(transaction=False)
+        for k in keys:
+            pipe.incr(self.prefix + k)
+        pipe.execute()
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + 'resp:*'):
+            self._client.delete(key)
+
+
+class TileCache:
+    """Caches serialized responses against tile generations.
+
+    Args:
+        backend: A MemoryBackend or RedisBackend.
+        ttl (int): Seconds an entry may be served for at most.
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    async def _call(self, fn, *args):
+        if self.backend.blocking:
+            return await run_blocking('cache', fn, *args)
+        return fn(*args)
+
+    async def generations(self, tiles):
+        """Current generations of `tiles`. Read these before running the
+        query whose result will be stored, so a concurrent invalidation
+        is never masked.
+        """
+        return await self._call(
+            self.backend.get_counters, generation_keys(tiles))
+
+    async def get(self, key, tiles):
+        """Returns the cached body for `key`, or None."""
+        raw = await self._call(self.backend.get, 'resp:' + key)
+        if raw is None:
+            self.misses += 1
+            return None
+
+        entry = ujson.loads(raw)
+        if entry['gens'] != await self.generations(tiles):
+            self.stale += 1
+            self.misses += 1
+            await self._call(self.backend.delete, 'resp:' + key)
+            return None
+
+        self.hits += 1
+        return entry['body']
+
+    async def set(self, key, body, generations):
+        """Stores a body along with the generations read before it was
+        produced.
+        """
+        raw = ujson.dumps({'gens': generations, 'body': body})
+        await self._call(self.backend.set, 'resp:' + key, raw, self.ttl)
+
+    def invalidate(self, points):
+        """Bumps the tiles containing the given (lat, lon) points, and
+        with them every wide search. Blocking; the worker calls this
+        directly, request handlers go through invalidate_async().
+        """
+        tiles = {tile_of(lat, lon) for lat, lon in points}
+        if not tiles:
+            return
+        if len(tiles) > config.CACHE_MAX_TILES:
+            self.backend.incr_counters([GLOBAL_KEY])
+        else:
+            self.backend.incr_counters(
+                [WIDE_KEY] + generation_keys(tiles)[1:])
+
+    async def invalidate_async(self, points):
+        await self._call(self.invalidate, points)
+
+    def invalidate_all(self):
+        """Bumps the global generation, expiring every entry."""
+        self.backend.incr_counters([GLOBAL_KEY])
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def events_key(**params):
+    """A cache key covering every parameter that shapes the response."""
+    return 'events:' + ujson.dumps(params, sort_keys=True)
+
+
+def build_cache():
+    """Creates the configured cache, or None if caching is disabled."""
+    if config.CACHE_BACKEND == 'none':
+        return None
+    if config.CACHE_BACKEND == 'redis':
+        backend = RedisBackend(config.CACHE_REDIS_URL)
+    else:
+        backend = MemoryBackend(config.CACHE_MAX_ENTRIES)
+    return TileCache(backend, config.CACHE_TTL)
+
+
+events_cache = build_cache()
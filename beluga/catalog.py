@@ -0,0 +1,63 @@
+"""In-process catalog of event categories.
+
+Categories change at most daily, so each process keeps them in memory.
+The copy is reloaded when the categories version moves on (see
+`beluga.versions`) or when it is older than CATEGORY_CATALOG_TTL seconds.
+"""
+import time
+
+from beluga import aiodb, config, queries
+
+
+class CategoryCatalog:
+    """Category names and ids, loaded from the database on demand.
+
+    Args:
+        ttl (int): Seconds a loaded copy may be used without knowing
+            the current categories version.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.names = []
+        self.ids = {}
+        self.by_id = {}
+        self.version = None
+        self.loaded_at = None
+        self.loads = 0
+
+    def fresh(self, version=None):
+        if self.loaded_at is None:
+            return False
+        if version is not None and version != self.version:
+            return False
+        return time.monotonic() - self.loaded_at < self.ttl
+
+    async def get(self, version=None):
+        """Returns the catalog, reloading it first if it is stale.
+
+        Args:
+            version (int): The current categories version, if the
+                caller has already read it.
+        """
+        # Concurrent reloads are harmless and rare, so none are
+        # serialized; the last one to finish wins.
+        if not self.fresh(version):
+            rows = await aiodb.fetch(queries.categories_select())
+            self.names = [r['name'] for r in rows]
+            self.ids = {r['name']: r['category_id'] for r in rows}
+            self.by_id = {r['category_id']: r['name'] for r in rows}
+            self.version = version
+            self.loaded_at = time.monotonic()
+            self.loads += 1
+        return self
+
+    def stats(self):
+        return {
+            'categories': len(self.names),
+            'version': self.version,
+            'loads': self.loads,
+        }
+
+
+category_catalog = CategoryCatalog(config.CATEGORY_CATALOG_TTL)
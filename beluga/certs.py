@@ -0,0 +1,128 @@
+"""Google's ID token signing certificates, cached per process.
+
+Logins verify Google ID tokens locally against these certificates. They
+are fetched with aiohttp and kept for as long as Google's Cache-Control
+header allows. Within GOOGLE_CERTS_REFRESH_BEFORE seconds of expiry a
+refresh starts in the background, and logins keep using the current
+copy, so only the first login of a process waits on Google.
+"""
+import asyncio
+import logging
+import re
+import time
+
+import aiohttp
+
+from beluga import config
+
+logger = logging.getLogger(__name__)
+
+_max_age = re.compile(r'max-age=(\d+)')
+
+
+class CertsUnavailable(Exception):
+    """No certificates are cached and they could not be fetched."""
+
+
+def cache_lifetime(headers, default):
+    """Seconds a response may be cached for, from its Cache-Control
+    max-age less its Age.
+    """
+    match = _max_age.search(headers.get('Cache-Control', ''))
+    if match is None:
+        return default
+    try:
+        age = int(headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    return max(int(match.group(1)) - age, 0)
+
+
+class CertCache:
+    """Key ids mapped to PEM certificates, fetched from `url`.
+
+    Args:
+        url (str): Where to fetch the certificates, as a JSON object.
+        min_ttl (int): Seconds to keep certificates whose response
+            had no usable cache headers.
+        refresh_before (int): Seconds before expiry to refresh in
+            the background.
+        timeout (int): Seconds to wait on the certificate server.
+    """
+
+    def __init__(self, url, min_ttl=60, refresh_before=300, timeout=5):
+        self.url = url
+        self.min_ttl = min_ttl
+        self.refresh_before = refresh_before
+        self.timeout = timeout
+        self._certs = None
+        self._expires = 0.0
+        self._pending = None
+        self.fetches = 0
+        self.failures = 0
+
+    async def get(self):
+        """Returns the certificates, fetching them first if none are
+        usable.
+
+        Raises:
+            CertsUnavailable: Nothing is cached and the fetch failed.
+        """
+        now = time.monotonic()
+        if self._certs is None or now >= self._expires:
+            return await self.refresh()
+        if now >= self._expires - self.refresh_before:
+            self.refresh()
+        return self._certs
+
+    def refresh(self):
+        """Starts a fetch unless one is already running. Returns a
+        future for its certificates.
+        """
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.ensure_future(self._fetch())
+        return self._pending
+
+    async def warm(self):
+        """Fetches the certificates ahead of the first login."""
+        try:
+            await self.refresh()
+        except CertsUnavailable as e:
+            logger.warning('Could not prefetch certificates: %s', e)
+
+    async def _fetch(self):
+        self.fetches += 1
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(self.url, timeout=self.timeout) as resp:
+                    resp.raise_for_status()
+                    certs = await resp.json(content_type=None)
+                    ttl = cache_lifetime(resp.headers, self.min_ttl)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.failures += 1
+            if self._certs is None:
+                raise CertsUnavailable(str(e))
+            # Keys outlive their advertised lifetime, so the old copy
+            # is better than none while Google is unreachable.
+            logger.warning('Keeping cached certificates: %s', e)
+            self._expires = time.monotonic() + self.min_ttl
+            return self._certs
+
+        self._certs = certs
+        self._expires = time.monotonic() + max(ttl, self.min_ttl)
+        return certs
+
+    def stats(self):
+        return {
+            'keys': len(self._certs or ()),
+            'expires_in': round(max(self._expires - time.monotonic(), 0)),
+            'fetches': self.fetches,
+            'failures': self.failures,
+        }
+
+
+google_certs = CertCache(
+    config.GOOGLE_CERTS_URL,
+    config.GOOGLE_CERTS_MIN_TTL,
+    config.GOOGLE_CERTS_REFRESH_BEFORE,
+    config.GOOGLE_CERTS_TIMEOUT)
@@ -0,0 +1,274 @@
+"""Negotiated compression of response bodies.
+
+gzip is always available. brotli (`br`) and zstd are offered when the
+`brotli` or `zstandard` packages are installed. The codec is chosen from
+the request's Accept-Encoding, preferring COMPRESSION_ENCODINGS order
+among equally weighted codings. Bodies under COMPRESSION_MIN_SIZE bytes
+are sent as they are. Bodies of COMPRESSION_OFFLOAD_SIZE bytes or more
+are compressed on the `compress` executor so the loop keeps serving.
+Streamed responses are compressed chunk by chunk.
+"""
+import threading
+import time
+import zlib
+
+from sanic.response import StreamingHTTPResponse
+
+from beluga import config
+from beluga.executor import run_blocking
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content types worth compressing; everything else is sent as is.
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+class GzipCodec:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.level = level
+
+    def _compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        c = self._compressobj()
+        return c.compress(data) + c.flush()
+
+    def stream(self):
+        c = self._compressobj()
+        return (lambda data: c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH),
+                c.flush)
+
+
+class BrotliCodec:
+    name = 'br'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self):
+        c = brotli.Compressor(quality=self.level)
+        return lambda data: c.process(data) + c.flush(), c.finish
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self):
+        c = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return (lambda data: c.compress(data) +
+                c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                c.flush)
+
+
+def build_codecs():
+    """The installed codecs named in COMPRESSION_ENCODINGS, in order."""
+    available = {'gzip': GzipCodec(config.COMPRESSION_GZIP_LEVEL)}
+    if brotli is not None:
+        available['br'] = BrotliCodec(config.COMPRESSION_BROTLI_QUALITY)
+    if zstandard is not None:
+        available['zstd'] = ZstdCodec(config.COMPRESSION_ZSTD_LEVEL)
+    return [available[name] for name in config.COMPRESSION_ENCODINGS
+            if name in available]
+
+
+codecs = build_codecs()
+
+
+def negotiate(accept_encoding, codecs=codecs):
+    """Picks a codec for an Accept-Encoding header, or None to send the
+    body as it is.
+    """
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for codec in codecs:
+        weight = weights.get(codec.name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = codec, weight
+    return best
+
+
+class CompressionStats:
+    """Bytes and time spent per encoding; updated from executor threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._encodings = {}
+        self._skipped = {'identity': 0, 'too_small': 0}
+
+    def _counters(self, name):
+        return self._encodings.setdefault(name, {
+            'responses': 0,
+            'chunks': 0,
+            'offloaded': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'seconds': 0.0,
+        })
+
+    def record(self, name, size_in, size_out, seconds, offloaded=False):
+        with self._lock:
+            counters = self._counters(name)
+            counters['chunks'] += 1
+            counters['offloaded'] += int(offloaded)
+            counters['bytes_in'] += size_in
+            counters['bytes_out'] += size_out
+            counters['seconds'] += seconds
+
+    def count_response(self, name):
+        with self._lock:
+            self._counters(name)['responses'] += 1
+
+    def skip(self, reason):
+        with self._lock:
+            self._skipped[reason] += 1
+
+    def stats(self):
+        with self._lock:
+            encodings = {}
+            for name, counters in self._encodings.items():
+                encodings[name] = dict(
+                    counters,
+                    bytes_saved=counters['bytes_in'] - counters['bytes_out'])
+            return {
+                'available': [codec.name for codec in codecs],
+                'encodings': encodings,
+                'skipped': dict(self._skipped),
+            }
+
+
+compression_stats = CompressionStats()
+
+
+def _compress(codec, data, offloaded=False):
+    started = time.perf_counter()
+    compressed = codec.compress(data)
+    compression_stats.record(
+        codec.name, len(data), len(compressed),
+        time.perf_counter() - started, offloaded)
+    return compressed
+
+
+class CompressedWriter:
+    """Stands in for a StreamingHTTPResponse, compressing each chunk
+    written to it.
+    """
+
+    def __init__(self, response, codec):
+        self.response = response
+        self.codec = codec
+        self._compress, self._finish = codec.stream()
+
+    @property
+    def transport(self):
+        return self.response.transport
+
+    def _send(self, fn, data=None):
+        started = time.perf_counter()
+        compressed = fn(data) if data is not None else fn()
+        compression_stats.record(
+            self.codec.name, len(data or b''), len(compressed),
+            time.perf_counter() - started)
+        # An empty chunk would end the chunked body early.
+        if compressed:
+            self.response.write(compressed)
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if data:
+            self._send(self._compress, data)
+
+    def finish(self):
+        self._send(self._finish)
+
+
+def _compress_stream(response, codec):
+    streaming_fn = response.streaming_fn
+
+    async def compressed_fn(response):
+        writer = CompressedWriter(response, codec)
+        await streaming_fn(writer)
+        writer.finish()
+
+    response.streaming_fn = compressed_fn
+
+
+async def compress_response(request, response):
+    """Response middleware compressing the body with the negotiated codec.
+
+    Example:
+
+        app.register_middleware(compress_response, 'response')
+    """
+    if 'Content-Encoding' in response.headers or response.status == 204:
+        return
+    content_type = response.headers.get('Content-Type', response.content_type)
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    codec = negotiate(request.headers.get('Accept-Encoding'))
+    if codec is None:
+        compression_stats.skip('identity')
+        return
+
+    if response.status != 304:
+        if isinstance(response, StreamingHTTPResponse):
+            _compress_stream(response, codec)
+        else:
+            body = response.body
+            if len(body) < config.COMPRESSION_MIN_SIZE:
+                compression_stats.skip('too_small')
+                return
+            if len(body) >= config.COMPRESSION_OFFLOAD_SIZE:
+                response.body = await run_blocking(
+                    'compress', _compress, codec, body, True)
+            else:
+                response.body = _compress(codec, body)
+        response.headers['Content-Encoding'] = codec.name
+        compression_stats.count_response(codec.name)
+
+    # The compressed body is a different representation of the same
+    # resource, so its tag can only be weak.
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = 'W/' + etag
+
+
+def stats():
+    return compression_stats.stats()
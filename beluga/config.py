@@ -5,6 +5,16 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 
 GOOGLE_CLIENT_ID = '148567986475-hjkjihnqn54603235u4rhilh54osclcc.apps.googleusercontent.com'
 
+# Google's ID token signing certificates, and how they are cached
+# (seconds): kept at least MIN_TTL, refreshed in the background
+# REFRESH_BEFORE they expire.
+GOOGLE_CERTS_URL = os.environ.get(
+    'GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+GOOGLE_CERTS_MIN_TTL = int(os.environ.get('GOOGLE_CERTS_MIN_TTL', 60))
+GOOGLE_CERTS_REFRESH_BEFORE = \
+    int(os.environ.get('GOOGLE_CERTS_REFRESH_BEFORE', 300))
+GOOGLE_CERTS_TIMEOUT = int(os.environ.get('GOOGLE_CERTS_TIMEOUT', 5))
+
 # This will be used to encrypt short-term cookies
 # A random value generated at start should suffice
 SECRET_BASE = os.environ.get('SECRET_BASE', os.urandom(64).hex())
@@ -20,3 +30,118 @@ DEFAULT_RAD = VANCOUVER_RAD
 
 # Date params
 DATE_FMT = '%Y-%m-%d'
+
+# Database connection pool. One pool is shared by every request
+# handled in a process (gunicorn worker, celery child).
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))  # sec
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # sec
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true') == 'true'
+
+# Async (asyncpg) pool used by the request handlers, per worker process.
+ASYNC_DB_POOL_MIN = int(os.environ.get('ASYNC_DB_POOL_MIN', 2))
+ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', 10))
+
+# Thread pools for blocking work started by request handlers,
+# as (threads, queue depth) per pool.
+EXECUTOR_POOLS = {
+    'db': (
+        int(os.environ.get('EXECUTOR_DB_WORKERS', DB_POOL_SIZE)),
+        int(os.environ.get('EXECUTOR_DB_QUEUE', 50))
+    ),
+    'auth': (
+        int(os.environ.get('EXECUTOR_AUTH_WORKERS', 4)),
+        int(os.environ.get('EXECUTOR_AUTH_QUEUE', 20))
+    ),
+    'cache': (
+        int(os.environ.get('EXECUTOR_CACHE_WORKERS', 4)),
+        int(os.environ.get('EXECUTOR_CACHE_QUEUE', 100))
+    ),
+    'compress': (
+        int(os.environ.get('EXECUTOR_COMPRESS_WORKERS', 2)),
+        int(os.environ.get('EXECUTOR_COMPRESS_QUEUE', 50))
+    ),
+}
+EXECUTOR_RETRY_AFTER = int(os.environ.get('EXECUTOR_RETRY_AFTER', 1))  # sec
+
+# Attendee profiles returned per event by GET /events.
+ATTENDEES_LIMIT_DEFAULT = int(os.environ.get('ATTENDEES_LIMIT_DEFAULT', 25))
+ATTENDEES_LIMIT_MAX = int(os.environ.get('ATTENDEES_LIMIT_MAX', 100))
+
+# GET /events response cache: 'memory' (per process), 'redis' (shared,
+# sees the worker's invalidations) or 'none'. Redis whenever there is
+# one, since a memory cache never learns of the worker's changes.
+CACHE_REDIS_URL = os.environ.get(
+    'CACHE_REDIS_URL', os.environ.get('CELERY_RESULT_BACKEND'))
+CACHE_BACKEND = os.environ.get(
+    'CACHE_BACKEND', 'redis' if CACHE_REDIS_URL else 'memory')
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 60))  # sec
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+CACHE_TILE_DEGREES = float(os.environ.get('CACHE_TILE_DEGREES', 0.1))
+CACHE_MAX_TILES = int(os.environ.get('CACHE_MAX_TILES', 64))
+CACHE_COORD_PRECISION = int(os.environ.get('CACHE_COORD_PRECISION', 3))
+
+# GET /events streams pages larger than this (or when stream=true)
+# from a server-side cursor, EVENTS_STREAM_BATCH rows at a time.
+EVENTS_STREAM_MIN_LIMIT = int(os.environ.get('EVENTS_STREAM_MIN_LIMIT', 200))
+EVENTS_STREAM_BATCH = int(os.environ.get('EVENTS_STREAM_BATCH', 50))
+EVENTS_STREAM_HIGH_WATER = int(
+    os.environ.get('EVENTS_STREAM_HIGH_WATER', 256 * 1024))  # bytes
+
+# POST /events/batch bounds: queries per request and events per query.
+EVENTS_BATCH_MAX_QUERIES = int(os.environ.get('EVENTS_BATCH_MAX_QUERIES', 20))
+EVENTS_BATCH_MAX_LIMIT = int(os.environ.get('EVENTS_BATCH_MAX_LIMIT', 200))
+
+# Seconds a process may serve its in-memory category catalog without
+# checking the categories version.
+CATEGORY_CATALOG_TTL = int(os.environ.get('CATEGORY_CATALOG_TTL', 300))
+
+# Response compression. Encodings are listed in order of preference;
+# br and zstd are only offered when brotli or zstandard is installed.
+COMPRESSION_ENCODINGS = os.environ.get(
+    'COMPRESSION_ENCODINGS', 'br,zstd,gzip').split(',')
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_OFFLOAD_SIZE = int(
+    os.environ.get('COMPRESSION_OFFLOAD_SIZE', 64 * 1024))  # bytes
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(
+    os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+
+# Rate limiting: token buckets per client IP and per user, kept in
+# process memory ('memory'), shared through Redis ('redis', the default
+# when there is one) or off ('none'). Rates are requests per second.
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', CACHE_REDIS_URL)
+RATE_LIMIT_BACKEND = os.environ.get(
+    'RATE_LIMIT_BACKEND', 'redis' if RATE_LIMIT_REDIS_URL else 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 10000))
+RATE_LIMIT_IP_RATE = float(os.environ.get('RATE_LIMIT_IP_RATE', 20))
+RATE_LIMIT_IP_BURST = int(os.environ.get('RATE_LIMIT_IP_BURST', 40))
+RATE_LIMIT_USER_RATE = float(os.environ.get('RATE_LIMIT_USER_RATE', 10))
+RATE_LIMIT_USER_BURST = int(os.environ.get('RATE_LIMIT_USER_BURST', 30))
+# Proxies in front of the app that append their peer's address to
+# X-Forwarded-For (1 behind Heroku's router). The client is the hop the
+# outermost of them added; anything left of it is the client's own say.
+RATE_LIMIT_TRUSTED_PROXIES = int(
+    os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 0))
+RATE_LIMIT_EXEMPT_PATHS = ('/',)  # health checks
+
+# Expensive endpoints admitted at once; the rest get a 503. The slots
+# live in the rate limit backend: shared by every worker with Redis,
+# per process otherwise. An admitted request holds its slot for
+# ADMISSION_LEASE_TTL seconds at most.
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 32))
+ADMISSION_LEASE_TTL = int(os.environ.get('ADMISSION_LEASE_TTL', 300))  # sec
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))  # sec
+
+# Verified bearer tokens kept per process, and for how long (seconds).
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', 10000))
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+
+# Access tokens: lifetime in seconds, and where revocations are kept
+# ('memory' per process, or 'redis' to share them between processes).
+ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', 3600))
+REVOCATION_BACKEND = os.environ.get('REVOCATION_BACKEND', 'memory')
+REVOCATION_REDIS_URL = os.environ.get('REVOCATION_REDIS_URL', CACHE_REDIS_URL)
+REVOCATION_SYNC_INTERVAL = int(os.environ.get('REVOCATION_SYNC_INTERVAL', 5))
@@ -0,0 +1,135 @@
+"""Bounded thread pools for blocking work started from request handlers.
+
+Each named pool has a fixed number of threads and a bounded queue. When
+both are full the request is rejected immediately with a 503 instead of
+piling up behind a slow dependency.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from sanic.exceptions import SanicException
+
+from beluga import config
+
+
+class ExecutorSaturated(SanicException):
+    """Raised when a pool has no free thread and a full queue."""
+    status_code = 503
+
+
+class BoundedExecutor:
+    """A thread pool that limits in-flight work and records metrics.
+
+    Args:
+        name (str): Pool name, used in errors and metrics.
+        max_workers (int): Number of threads.
+        max_queue (int): Calls allowed to wait for a free thread.
+    """
+
+    def __init__(self, name, max_workers, max_queue):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        self._counters = {
+            'submitted': 0,
+            'rejected': 0,
+            'completed': 0,
+            'failed': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'run_total': 0.0,
+        }
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on the pool and awaits its result.
+
+        Raises:
+            ExecutorSaturated: If the pool and its queue are full.
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self._counters['rejected'] += 1
+                raise ExecutorSaturated(
+                    f'{self.name} pool is saturated')
+            self._in_flight += 1
+            self._counters['submitted'] += 1
+
+        queued_at = time.monotonic()
+
+        def call():
+            started = time.monotonic()
+            with self._lock:
+                self._running += 1
+                waited = started - queued_at
+                self._counters['wait_total'] += waited
+                self._counters['wait_max'] = max(
+                    self._counters['wait_max'], waited)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._counters['run_total'] += time.monotonic() - started
+
+        try:
+            loop = asyncio.get_event_loop()
+            result = await loop.run_in_executor(self._pool, call)
+        except Exception:
+            with self._lock:
+                self._counters['failed'] += 1
+            raise
+        else:
+            with self._lock:
+                self._counters['completed'] += 1
+            return result
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        """Returns queue depth and wait-time metrics for this pool."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update(
+                max_workers=self.max_workers,
+                max_queue=self.max_queue,
+                running=self._running,
+                queued=self._in_flight - self._running)
+        return stats
+
+
+# Pools are created on first use so each forked worker gets its own threads.
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name):
+    """Returns the process-wide executor configured under `name`."""
+    if name not in _executors:
+        with _executors_lock:
+            if name not in _executors:
+                max_workers, max_queue = config.EXECUTOR_POOLS[name]
+                _executors[name] = BoundedExecutor(
+                    name, max_workers, max_queue)
+    return _executors[name]
+
+
+async def run_blocking(pool, fn, *args, **kwargs):
+    """Runs a blocking call on the named pool without blocking the loop.
+
+    Example:
+
+        user_id = await run_blocking('db', upsert_user, idinfo)
+    """
+    return await get_executor(pool).run(fn, *args, **kwargs)
+
+
+def stats():
+    """Returns metrics for every executor created in this process."""
+    return {name: e.stats() for name, e in _executors.items()}
@@ -1,12 +1,19 @@
+import datetime as dt
 import logging
 import os
+import threading
+import time
 
 from contextlib import contextmanager
 
 from geoalchemy2 import Geography
 import sqlalchemy as sa
+from sqlalchemy import event, exc
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
 
+from beluga import config
+
 # Base for all table.
 Base = declarative_base()
 
@@ -17,28 +24,136 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# One engine and session factory per process, built on first use.
+_engine = None
+_session_factory = None
+_engine_lock = threading.Lock()
+
+# Counters maintained by the pool instrumentation below.
+_pool_counters = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkout_timeouts': 0,
+    'checkout_wait_total': 0.0,
+    'checkout_wait_max': 0.0,
+    'foreign_pid_discards': 0,
+}
+
+
+class InstrumentedQueuePool(sa.pool.QueuePool):
+    """A QueuePool that records how long checkouts wait for a
+    connection to become available.
+    """
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            _pool_counters['checkout_timeouts'] += 1
+            raise
+        finally:
+            waited = time.monotonic() - started
+            _pool_counters['checkout_wait_total'] += waited
+            _pool_counters['checkout_wait_max'] = max(
+                _pool_counters['checkout_wait_max'], waited)
+
+
+def _instrument_engine(engine):
+    """Attach fork safety, pre-ping and statistics listeners."""
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        _pool_counters['connects'] += 1
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        # A connection inherited through fork() (gunicorn, celery prefork)
+        # shares its socket with the parent. Drop it without closing so
+        # the parent's session survives, and let the pool reconnect.
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            _pool_counters['foreign_pid_discards'] += 1
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid {}, '
+                'attempting to check out in pid {}'.format(
+                    connection_record.info['pid'], pid))
+        _pool_counters['checkouts'] += 1
+
+    if config.DB_POOL_PRE_PING:
+        @event.listens_for(engine, 'engine_connect')
+        def ping_connection(connection, branch):
+            # Pessimistic disconnect handling; a stale connection is
+            # invalidated and transparently replaced before use.
+            if branch:
+                return
+            should_close = connection.should_close_with_result
+            connection.should_close_with_result = False
+            try:
+                connection.scalar(sa.select([1]))
+            except exc.DBAPIError as err:
+                if err.connection_invalidated:
+                    connection.scalar(sa.select([1]))
+                else:
+                    raise
+            finally:
+                connection.should_close_with_result = should_close
+
 
 def get_engine():
-    """Creates a database engine from our database url string."""
-    return sa.create_engine(
-        DATABASE_URL,
-        convert_unicode=True)
+    """Returns the process-wide database engine, creating
+    it on first use.
+    """
+    global _engine, _session_factory
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = sa.create_engine(
+                    DATABASE_URL,
+                    convert_unicode=True,
+                    poolclass=InstrumentedQueuePool,
+                    pool_size=config.DB_POOL_SIZE,
+                    max_overflow=config.DB_POOL_MAX_OVERFLOW,
+                    pool_timeout=config.DB_POOL_TIMEOUT,
+                    pool_recycle=config.DB_POOL_RECYCLE)
+                _instrument_engine(engine)
+                _session_factory = sa.orm.sessionmaker(
+                    autocommit=False,
+                    autoflush=False,
+                    bind=engine)
+                _engine = engine
+    return _engine
+
+
+def pool_stats():
+    """Returns checkout and wait statistics for the engine's pool."""
+    stats = dict(_pool_counters)
+    if _engine is not None:
+        pool = _engine.pool
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow())
+    return stats
 
 
 def db_setup():
     """Stand tables."""
     logger.info('Standing tables.')
     Base.metadata.create_all(get_engine())
+    # Left to the worker's daily rebuild once it exists.
+    with get_engine().begin() as conn:
+        conn.execute(upcoming_index_ddl(UPCOMING_INDEX, upcoming_cutoff()))
 
 
 @contextmanager
 def session_scope():
     """Provide a transactional scope around a series of operations."""
-    session = sa.orm.scoped_session(
-        sa.orm.sessionmaker(
-            autocommit=False,
-            autoflush=False,
-            bind=get_engine()))
+    get_engine()
+    session = _session_factory()
     try:
         yield session
         session.commit()
@@ -49,6 +164,13 @@ def session_scope():
         session.close()
 
 
+# Bumped after every committed change to the data behind GET /events
+# and /categories; see beluga.versions.
+events_version_seq = sa.Sequence('events_version_seq', metadata=Base.metadata)
+categories_version_seq = sa.Sequence(
+    'categories_version_seq', metadata=Base.metadata)
+
+
 class User(Base):
     """A user represents an individual user of the application."""
 
@@ -66,6 +188,12 @@ class User(Base):
     login_secret = sa.Column(sa.types.JSON) # Seperate security level for secrets
     login_info = sa.Column(sa.types.JSON)
 
+    # Logins upsert on (service, uid), which needs this to be unique.
+    __table_args__ = (
+        sa.Index(
+            'ux_users_login', 'login_service', 'login_uid', unique=True),
+    )
+
     def __str__(self):
         return '<[{}] User {} {}>'.format(
             self.id, self.given_name, self.surname
@@ -87,9 +215,13 @@ class Event(Base):
     start_time_local = sa.Column(sa.types.DateTime())
     end_time_local = sa.Column(sa.types.DateTime())
     timezone = sa.Column(sa.String(50))
-    location = sa.Column(Geography(geometry_type='POINT', srid=4326))
+    location = sa.Column(Geography(
+        geometry_type='POINT', srid=4326, spatial_index=False))
+    # Plain copies of the location's coordinates, so reads don't
+    # have to decode the geography.
+    latitude = sa.Column(sa.Float())
+    longitude = sa.Column(sa.Float())
     title = sa.Column(sa.String(200))
-    attendees = sa.Column(sa.types.JSON)
     capacity = sa.Column(sa.Integer())
     logo = sa.Column(sa.types.JSON)
     url = sa.Column(sa.String(200))
@@ -102,6 +234,23 @@ class Event(Base):
         sa.ForeignKey("categories.category_id"),
         nullable=True  # eventbrite has null categories :(
     )
+    # Weighted title and description words; see search_document().
+    search_vector = sa.Column(TSVECTOR())
+    # Digest of the Eventbrite data the row was loaded from, so
+    # unchanged events are not rewritten.
+    content_hash = sa.Column(sa.String(40))
+
+    # Serve the ST_DWithin and time-range filters of GET /events and
+    # the end_time cutoff of the worker's cleanup.
+    __table_args__ = (
+        sa.Index('idx_events_location', 'location', postgresql_using='gist'),
+        sa.Index('ix_events_start_time', 'start_time'),
+        sa.Index('ix_events_end_time', 'end_time'),
+        sa.Index('ix_events_category_id', 'category_id'),
+        sa.Index(
+            'ix_events_search_vector', 'search_vector',
+            postgresql_using='gin'),
+    )
 
     def __str__(self):
         return '<[{}] Event {}>'.format(
@@ -109,6 +258,101 @@ class Event(Base):
         )
 
 
+# Text search configuration used to build and to query search_vector.
+SEARCH_CONFIG = sa.literal_column("'english'::regconfig")
+
+
+def search_document(title, description_text):
+    """The tsvector stored in Event.search_vector. Title words are
+    weighted above description words so they rank higher.
+    """
+    def weighted(text, weight):
+        return sa.func.setweight(
+            sa.func.to_tsvector(SEARCH_CONFIG, sa.func.coalesce(text, '')),
+            sa.literal_column(f"'{weight}'"))
+
+    return weighted(title, 'A').op('||')(weighted(description_text, 'B'))
+
+
+# Listed events starting on or after a cutoff date get their own
+# partial index, ordered as the start_time sort reads them. A
+# predicate can't say "from today", so the cutoff is a literal: the
+# worker rebuilds the index on each new day, and queries repeat the
+# literal so the planner can match them to it.
+UPCOMING_INDEX = 'ix_events_upcoming'
+UPCOMING_WHERE = \
+    "category_id IS NOT NULL AND start_time >= '{}'::timestamp"
+
+
+def upcoming_cutoff():
+    """The cutoff date the upcoming-events index is built on today."""
+    return dt.date.today()
+
+
+def upcoming_predicate(cutoff):
+    """The rows of an upcoming-events index built on `cutoff`. Queries
+    filtering on this with any cutoff at or after the index's can use
+    it.
+    """
+    return sa.and_(
+        Event.category_id.isnot(None),
+        Event.start_time >= sa.literal_column(
+            f"'{cutoff.isoformat()}'::timestamp"))
+
+
+def upcoming_index_ddl(name, cutoff, concurrently=False):
+    return 'CREATE INDEX {}{} ON events (start_time, id) WHERE {}'.format(
+        'CONCURRENTLY ' if concurrently else 'IF NOT EXISTS ', name,
+        UPCOMING_WHERE.format(cutoff.isoformat()))
+
+
+def refresh_upcoming_index(cutoff=None):
+    """Rebuilds the upcoming-events index on `cutoff`, today by
+    default, without blocking writes to events.
+    """
+    cutoff = cutoff or upcoming_cutoff()
+    building = UPCOMING_INDEX + '_new'
+    with get_engine().connect() as conn:
+        # CONCURRENTLY can't run inside a transaction.
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {building}')
+        conn.execute(upcoming_index_ddl(building, cutoff, concurrently=True))
+        conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {UPCOMING_INDEX}')
+        conn.execute(f'ALTER INDEX {building} RENAME TO {UPCOMING_INDEX}')
+
+
+class EventAttendee(Base):
+    """An RSVP from a user to an event."""
+
+    __tablename__ = 'event_attendees'
+
+    event_id = sa.Column(
+        sa.BigInteger,
+        sa.ForeignKey("events.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+    user_id = sa.Column(
+        sa.BigInteger,
+        sa.ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+    created_at = sa.Column(
+        sa.types.DateTime(),
+        nullable=False,
+        server_default=sa.func.now()
+    )
+
+    # The primary key serves lookups by event; this one serves by user.
+    __table_args__ = (
+        sa.Index('ix_event_attendees_user_id_event_id', 'user_id', 'event_id'),
+    )
+
+    def __str__(self):
+        return '<Event {} attendee {}>'.format(
+            self.event_id, self.user_id
+        )
+
+
 class Category(Base):
     """An category represents an event genre as specifed by eventbrite."""
 
@@ -125,3 +369,23 @@ class Category(Base):
         return '<[{}] Category {}>'.format(
             self.id, self.title
         )
+
+
+class Venue(Base):
+    """Where an Eventbrite venue is, as last fetched from Eventbrite."""
+
+    __tablename__ = 'venues'
+
+    id = sa.Column(sa.String(32), primary_key=True)
+    latitude = sa.Column(sa.Float, nullable=False)
+    longitude = sa.Column(sa.Float, nullable=False)
+    fetched_at = sa.Column(
+        sa.types.DateTime(),
+        nullable=False,
+        server_default=sa.func.now()
+    )
+
+    def __str__(self):
+        return '<[{}] Venue {} {}>'.format(
+            self.id, self.latitude, self.longitude
+        )
@@ -0,0 +1,323 @@
+"""SQL statements shared by the request handlers.
+
+Statements are plain SQLAlchemy Core so they can run either through
+`beluga.aiodb` on the event loop or through a `session_scope()`.
+"""
+from collections import namedtuple
+import datetime as dt
+
+from geoalchemy2 import Geography, WKTElement
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as psql
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from beluga.models import (
+    Event, EventAttendee, Category, User, SEARCH_CONFIG, upcoming_cutoff,
+    upcoming_predicate)
+
+
+# Orderings supported by events_select; each is paired with Event.id
+# so that keyset positions are unique. Relevance needs a search query
+# and is best first, the others ascend.
+SORT_KEYS = ('distance', 'start_time', 'relevance')
+
+# Keys of an /events result, in response order. The attendee fields
+# are resolved by separate queries rather than columns of the select.
+EVENT_FIELDS = (
+    'title', 'description_html', 'description_text', 'location',
+    'start_time', 'end_time', 'distance', 'category', 'id',
+    'attendees', 'attendee_count')
+
+# A compact projection for list and map views.
+SUMMARY_FIELDS = ('title', 'location', 'start_time', 'id')
+
+# One query of a batch: a search circle of `dist` metres, time window,
+# optional category id and row limit.
+Area = namedtuple('Area', [
+    'lat', 'lon', 'dist', 'start_time', 'end_time', 'category_id', 'limit'])
+
+# A keyset position: the sort value and id of the last row seen, and
+# whether to page backwards from it.
+Cursor = namedtuple('Cursor', ['value', 'id', 'backwards'])
+
+
+def center_point(lat, lon):
+    """Builds the geography point for a search center."""
+    return WKTElement(f"POINT({lon} {lat})")
+
+
+def events_select(lat, lon, dist, start_time, end_time,
+                  category_id=None, limit=50, sort='distance', cursor=None,
+                  fields=EVENT_FIELDS, q=None):
+    """Events within `dist` metres of (lat, lon), nearest first.
+
+    Pages are addressed by keyset rather than OFFSET: given a `cursor`,
+    only rows strictly after (or, paging backwards, before) its
+    (sort value, id) are selected, so every page costs the same.
+    Backward pages come back in reverse order.
+
+    Args:
+        lat (float): Latitude of the search center.
+        lon (float): Longitude of the search center.
+        dist (float): Search radius in metres.
+        start_time (datetime): Earliest start time.
+        end_time (datetime): Latest end time.
+        category_id (int): Optional category filter.
+        limit (int): Maximum number of events.
+        sort (str): One of SORT_KEYS.
+        cursor (Cursor): Optional position to page from.
+        fields (tuple): EVENT_FIELDS to select. The id and sort value
+            are always selected since cursors are built from them.
+        q (str): Optional full-text search; only matching events are
+            selected. Required for the `relevance` sort.
+    """
+    center = center_point(lat, lon)
+    distance = Event.location.ST_Distance(center, type_=sa.Float)
+    distance_col = distance.label('distance')
+
+    if q:
+        ts_query = sa.func.plainto_tsquery(SEARCH_CONFIG, q)
+        rank = sa.func.ts_rank(Event.search_vector, ts_query, type_=sa.Float)
+        rank_col = rank.label('relevance')
+
+    cols = [Event.id] + event_columns(set(fields) | {sort}, distance_col)
+    if sort == 'relevance':
+        cols.append(rank_col)
+
+    query = (
+        sa.select(cols)
+        .where(Event.category_id.isnot(None))
+        .where(Event.start_time >= start_time)
+        .where(Event.end_time <= end_time)
+        .where(Event.location.ST_DWithin(center, dist))
+        .limit(limit)
+    )
+
+    if q:
+        query = query.where(Event.search_vector.op('@@')(ts_query))
+
+    if sort == 'distance':
+        sort_col, order_col = distance, distance_col
+    elif sort == 'relevance':
+        sort_col, order_col = rank, rank_col
+    else:
+        sort_col = order_col = Event.start_time
+    backwards = cursor is not None and cursor.backwards
+    descending = backwards != (sort == 'relevance')
+
+    if cursor is not None:
+        key = sa.tuple_(sort_col, Event.id)
+        position = sa.tuple_(
+            sa.bindparam('cursor_value', cursor.value, type_=sort_col.type),
+            sa.bindparam('cursor_id', cursor.id, type_=sa.BigInteger))
+        query = query.where(key < position if descending else key > position)
+
+    if descending:
+        query = query.order_by(order_col.desc(), Event.id.desc())
+    else:
+        query = query.order_by(order_col.asc(), Event.id.asc())
+
+    if category_id is not None:
+        query = query.where(Event.category_id == category_id)
+
+    # Spelled out so the planner can use the upcoming-events index,
+    # which windows starting before its cutoff can't.
+    cutoff = upcoming_cutoff()
+    if start_time >= dt.datetime.combine(cutoff, dt.time()):
+        query = query.where(upcoming_predicate(cutoff))
+
+    return query
+
+
+def event_columns(fields, distance_col):
+    """The columns behind the given EVENT_FIELDS, in response order.
+    Categories are selected by id; names come from the category catalog.
+    """
+    field_cols = {
+        'title': [Event.title],
+        'description_html': [Event.description_html],
+        'description_text': [Event.description_text],
+        'location': [Event.latitude, Event.longitude],
+        'start_time': [Event.start_time],
+        'end_time': [Event.end_time],
+        'distance': [distance_col],
+        'category': [Event.category_id],
+    }
+    cols = []
+    for field in EVENT_FIELDS:
+        if field in fields:
+            cols += field_cols.get(field, [])
+    return cols
+
+
+def areas_events_select(areas, fields=EVENT_FIELDS):
+    """Events for several Areas in one statement, nearest first within
+    each area.
+
+    The areas are bound as one array per Area field and unnested into
+    rows, so the statement text is the same however many areas there
+    are. Each row drives a LATERAL subquery that can use the spatial
+    index just like events_select does. Rows carry the position of
+    their area in `areas` as `area`.
+    """
+    areas = list(areas)
+
+    def array(name, values, sql_type):
+        return sa.bindparam(name, values, type_=ARRAY(sql_type))
+
+    area_rows = sa.text("""
+        SELECT * FROM unnest(
+            CAST(:area_idx AS integer[]),
+            CAST(:area_lat AS double precision[]),
+            CAST(:area_lon AS double precision[]),
+            CAST(:area_dist AS double precision[]),
+            CAST(:area_start_time AS timestamp[]),
+            CAST(:area_end_time AS timestamp[]),
+            CAST(:area_category_id AS bigint[]),
+            CAST(:area_limit AS integer[])
+        ) AS a(idx, lat, lon, dist, start_time, end_time, category_id,
+               row_limit)
+    """).bindparams(
+        array('area_idx', list(range(len(areas))), sa.Integer),
+        array('area_lat', [a.lat for a in areas], sa.Float),
+        array('area_lon', [a.lon for a in areas], sa.Float),
+        array('area_dist', [a.dist for a in areas], sa.Float),
+        array('area_start_time', [a.start_time for a in areas], sa.DateTime),
+        array('area_end_time', [a.end_time for a in areas], sa.DateTime),
+        array('area_category_id', [a.category_id for a in areas],
+              sa.BigInteger),
+        array('area_limit', [a.limit for a in areas], sa.Integer),
+    ).columns(
+        sa.column('idx', sa.Integer),
+        sa.column('lat', sa.Float),
+        sa.column('lon', sa.Float),
+        sa.column('dist', sa.Float),
+        sa.column('start_time', sa.DateTime),
+        sa.column('end_time', sa.DateTime),
+        sa.column('category_id', sa.BigInteger),
+        sa.column('row_limit', sa.Integer),
+    ).alias('areas')
+
+    center = sa.cast(
+        sa.func.ST_SetSRID(
+            sa.func.ST_MakePoint(area_rows.c.lon, area_rows.c.lat), 4326),
+        Geography(geometry_type='POINT', srid=4326))
+    distance = Event.location.ST_Distance(center, type_=sa.Float)
+    distance_col = distance.label('distance')
+
+    events = (
+        sa.select(
+            [Event.id] + event_columns(set(fields) | {'distance'},
+                                       distance_col))
+        .where(Event.category_id.isnot(None))
+        .where(Event.start_time >= area_rows.c.start_time)
+        .where(Event.end_time <= area_rows.c.end_time)
+        .where(Event.location.ST_DWithin(center, area_rows.c.dist))
+        .where(sa.or_(area_rows.c.category_id.is_(None),
+                      Event.category_id == area_rows.c.category_id))
+        .order_by(distance_col.asc(), Event.id.asc())
+        .limit(area_rows.c.row_limit)
+        .correlate(area_rows)
+        .lateral('area_events')
+    )
+
+    return (
+        sa.select([area_rows.c.idx.label('area'), events])
+        .select_from(area_rows.join(events, sa.true()))
+        .order_by(area_rows.c.idx, events.c.distance, events.c.id)
+    )
+
+
+def attendee_ids_select(event_ids, limit):
+    """Attendee count and the ids of the first `limit` attendees,
+    in RSVP order, for each of the given events.
+    """
+    ids = sa.bindparam('event_ids', list(event_ids), type_=ARRAY(sa.BigInteger))
+    user_ids = psql.array_agg(psql.aggregate_order_by(
+        EventAttendee.user_id, EventAttendee.created_at))
+    return (
+        sa.select([
+            EventAttendee.event_id,
+            sa.func.count().label('total'),
+            user_ids[1:limit].label('user_ids')
+        ])
+        .where(EventAttendee.event_id == sa.any_(ids))
+        .group_by(EventAttendee.event_id)
+    )
+
+
+def rsvp_insert(event_id, user_id):
+    """Idempotently records an RSVP."""
+    return (
+        psql.insert(EventAttendee)
+        .values(event_id=event_id, user_id=user_id)
+        .on_conflict_do_nothing()
+    )
+
+
+def rsvp_delete(event_id, user_id):
+    """Idempotently clears an RSVP."""
+    return (
+        EventAttendee.__table__.delete()
+        .where(EventAttendee.event_id == event_id)
+        .where(EventAttendee.user_id == user_id)
+    )
+
+
+def event_point(event_id):
+    """The latitude and longitude of an event."""
+    return (
+        sa.select([Event.latitude, Event.longitude])
+        .where(Event.id == event_id)
+    )
+
+
+def event_exists(event_id):
+    return sa.select([sa.exists().where(Event.id == event_id)])
+
+
+def attendees_select(user_ids):
+    """Public profile columns for the given user ids.
+
+    The ids are bound as one array parameter, so the statement text is
+    the same however many attendees a page has.
+    """
+    ids = sa.bindparam('user_ids', list(user_ids), type_=ARRAY(sa.BigInteger))
+    return (
+        sa.select([User.id, User.given_name, User.surname, User.avatar])
+        .where(User.id == sa.any_(ids))
+    )
+
+
+def user_select(user_id):
+    """The columns of a user needed to authorize a request."""
+    return (
+        sa.select([User.id, User.given_name, User.surname, User.avatar])
+        .where(User.id == user_id)
+    )
+
+
+def login_upsert(service, uid, given_name, surname, avatar, info):
+    """Creates the user for an account with a login service, or
+    refreshes its login info if it exists. Returns the columns of
+    `user_select`.
+    """
+    stmt = psql.insert(User).values(
+        given_name=given_name,
+        surname=surname,
+        avatar=avatar,
+        login_service=service,
+        login_uid=uid,
+        login_info=info
+    )
+    return (
+        stmt.on_conflict_do_update(
+            index_elements=[User.login_service, User.login_uid],
+            set_={'login_info': stmt.excluded.login_info})
+        .returning(User.id, User.given_name, User.surname, User.avatar)
+    )
+
+
+def categories_select():
+    """All category ids and names."""
+    return sa.select([Category.category_id, Category.name])
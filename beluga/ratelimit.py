@@ -0,0 +1,383 @@
+"""Admission control: token buckets per client and a concurrency cap.
+
+Every request is charged to a bucket for its client IP, and every
+authorized request to a bucket for its user id. An empty bucket means a
+429 with Retry-After. Buckets live in process memory or, with
+RATE_LIMIT_BACKEND=redis, in Redis where all gunicorn workers share
+them.
+
+Expensive endpoints are also wrapped in `admission()`, which caps the
+requests in flight and sheds the rest with a 503. With the Redis
+backend the cap is shared by all workers: each admitted request holds
+a lease that expires after ADMISSION_LEASE_TTL, so the slots of a
+crashed worker come back.
+"""
+import asyncio
+from collections import OrderedDict
+from functools import wraps
+import threading
+import time
+import uuid
+
+from sanic.exceptions import SanicException
+from sanic.response import StreamingHTTPResponse
+
+from beluga import config
+from beluga.executor import run_blocking
+
+
+class RateLimited(SanicException):
+    """Raised when a client's bucket is empty."""
+    status_code = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(SanicException):
+    """Raised when too many expensive requests are in flight."""
+    status_code = 503
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class MemoryBackend:
+    """Buckets for this process only, least recently used evicted."""
+
+    blocking = False
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from `key`'s bucket. Returns (allowed,
+        seconds until a token is available).
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def admit(self, key, limit, lease, ttl):
+        """Grants `lease` on one of `key`'s `limit` slots for up to
+        `ttl` seconds. Returns whether a slot was free.
+        """
+        now = time.monotonic()
+        with self._lock:
+            leases = self._leases.setdefault(key, {})
+            for held, expires in list(leases.items()):
+                if expires <= now:
+                    del leases[held]
+            if len(leases) >= limit:
+                return False
+            leases[lease] = now + ttl
+            return True
+
+    def leave(self, key, lease):
+        """Gives back a slot taken by `admit()`."""
+        with self._lock:
+            self._leases.get(key, {}).pop(lease, None)
+
+
+# Refill and take in one atomic step. Returns {allowed, retry_after};
+# the float goes back as a string since Redis truncates Lua numbers.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+# Drop expired leases, then lease a slot if one is free. Leases are
+# members of a sorted set scored by their expiry.
+ADMIT_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local now = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[2])
+redis.call('EXPIRE', KEYS[1], math.ceil(ttl) + 1)
+return 1
+"""
+
+
+class RedisBackend:
+    """Buckets shared by every process using the same Redis."""
+
+    blocking = True
+
+    def __init__(self, url, prefix='beluga:ratelimit:'):
+        import redis
+        self.prefix = prefix
+        self._client = redis.StrictRedis.from_url(url)
+        self._take = self._client.register_script(TAKE_SCRIPT)
+        self._admit = self._client.register_script(ADMIT_SCRIPT)
+
+    def take(self, key, rate, burst):
+        allowed, retry_after = self._take(
+            keys=[self.prefix + key], args=[rate, burst, time.time()])
+        return bool(allowed), float(retry_after)
+
+    def admit(self, key, limit, lease, ttl):
+        return bool(self._admit(
+            keys=[self.prefix + key], args=[limit, lease, time.time(), ttl]))
+
+    def leave(self, key, lease):
+        self._client.zrem(self.prefix + key, lease)
+
+
+class TokenBucketLimiter:
+    """Allows `rate` requests a second per key, in bursts of `burst`.
+
+    Args:
+        backend: A MemoryBackend or RedisBackend.
+        name (str): Bucket namespace, used in keys and metrics.
+        rate (float): Tokens added per second.
+        burst (int): Bucket capacity.
+    """
+
+    def __init__(self, backend, name, rate, burst):
+        self.backend = backend
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.allowed = 0
+        self.rejected = 0
+
+    async def check(self, key):
+        """Charges one request to `key`.
+
+        Raises:
+            RateLimited: If the bucket is empty.
+        """
+        args = (f'{self.name}:{key}', self.rate, self.burst)
+        if self.backend.blocking:
+            allowed, retry_after = await run_blocking(
+                'cache', self.backend.take, *args)
+        else:
+            allowed, retry_after = self.backend.take(*args)
+
+        if allowed:
+            self.allowed += 1
+            return
+        self.rejected += 1
+        raise RateLimited(f'{self.name} rate limit exceeded', retry_after)
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+        }
+
+
+class ConcurrencyLimiter:
+    """Caps the expensive requests in flight across every process
+    sharing `backend`.
+
+    Args:
+        backend: A MemoryBackend or RedisBackend.
+        max_in_flight (int): Requests admitted at once.
+        lease_ttl (int): Seconds a request holds its slot at most.
+        name (str): Key of the shared slots.
+    """
+
+    def __init__(self, backend, max_in_flight, lease_ttl=300,
+                 name='admission'):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.lease_ttl = lease_ttl
+        self.name = name
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        """Takes a slot. Returns the lease to release it with.
+
+        Raises:
+            Overloaded: If no slot is free.
+        """
+        lease = uuid.uuid4().hex
+        args = (self.name, self.max_in_flight, lease, self.lease_ttl)
+        if self.backend.blocking:
+            allowed = await run_blocking('cache', self.backend.admit, *args)
+        else:
+            allowed = self.backend.admit(*args)
+
+        if not allowed:
+            self.rejected += 1
+            raise Overloaded(
+                'too many requests in flight', config.ADMISSION_RETRY_AFTER)
+        self.in_flight += 1
+        self.admitted += 1
+        return lease
+
+    def release(self, lease):
+        """Gives back a slot. Callable from callbacks, so a shared
+        backend is told in the background.
+        """
+        self.in_flight -= 1
+        if self.backend.blocking:
+            asyncio.ensure_future(
+                run_blocking('cache', self.backend.leave, self.name, lease))
+        else:
+            self.backend.leave(self.name, lease)
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+        }
+
+
+def build_limiters():
+    """Creates the configured per-IP and per-user limiters, Nones if
+    rate limiting is disabled, and the admission limiter, which shares
+    their backend and is always on.
+    """
+    if config.RATE_LIMIT_BACKEND == 'redis':
+        backend = RedisBackend(config.RATE_LIMIT_REDIS_URL)
+    else:
+        backend = MemoryBackend(config.RATE_LIMIT_MAX_KEYS)
+    concurrency = ConcurrencyLimiter(
+        backend, config.ADMISSION_MAX_IN_FLIGHT, config.ADMISSION_LEASE_TTL)
+
+    if config.RATE_LIMIT_BACKEND == 'none':
+        return None, None, concurrency
+    return (
+        TokenBucketLimiter(backend, 'ip', config.RATE_LIMIT_IP_RATE,
+                           config.RATE_LIMIT_IP_BURST),
+        TokenBucketLimiter(backend, 'user', config.RATE_LIMIT_USER_RATE,
+                           config.RATE_LIMIT_USER_BURST),
+        concurrency,
+    )
+
+
+ip_limiter, user_limiter, expensive = build_limiters()
+
+
+def client_ip(request):
+    """The address a request is charged to: the peer, or behind
+    RATE_LIMIT_TRUSTED_PROXIES proxies, the X-Forwarded-For hop counted
+    that far from the right.
+    """
+    proxies = config.RATE_LIMIT_TRUSTED_PROXIES
+    if proxies:
+        hops = [hop.strip() for hop in
+                request.headers.get('X-Forwarded-For', '').split(',')
+                if hop.strip()]
+        if hops:
+            # Fewer hops than proxies means none came from the client.
+            return hops[-min(proxies, len(hops))]
+    return request.ip[0]
+
+
+async def limit_ip(request):
+    """Request middleware charging each request to its client IP."""
+    if ip_limiter is not None and \
+            request.path not in config.RATE_LIMIT_EXEMPT_PATHS:
+        await ip_limiter.check(client_ip(request))
+
+
+async def limit_user(user_id):
+    """Charges a request to an authorized user."""
+    if user_limiter is not None:
+        await user_limiter.check(user_id)
+
+
+def admission():
+    """A decorator shedding load once too many expensive requests are
+    in flight. A streamed response holds its slot until it finishes.
+
+    Example:
+
+        @api.route('/events', ['GET'])
+        @admission()
+        @authorized()
+        async def event_handler(request, user):
+            ...
+    """
+    def decorator(f):
+        @wraps(f)
+        async def decorated_function(request, *args, **kwargs):
+            lease = await expensive.acquire()
+            released = False
+
+            def release(*_):
+                nonlocal released
+                if not released:
+                    released = True
+                    expensive.release(lease)
+
+            try:
+                response = await f(request, *args, **kwargs)
+            except Exception:
+                release()
+                raise
+
+            if not isinstance(response, StreamingHTTPResponse):
+                release()
+                return response
+
+            # Sanic streams the response from the task running this
+            # handler, so the slot is freed when that task ends even if
+            # the stream fails or is cancelled before it starts.
+            asyncio.Task.current_task().add_done_callback(release)
+
+            streaming_fn = response.streaming_fn
+
+            async def held(response):
+                try:
+                    await streaming_fn(response)
+                finally:
+                    release()
+
+            response.streaming_fn = held
+            return response
+
+        return decorated_function
+    return decorator
+
+
+def stats():
+    return {
+        'ip': ip_limiter.stats() if ip_limiter else None,
+        'user': user_limiter.stats() if user_limiter else None,
+        'admission': expensive.stats(),
+    }
+
@@ -0,0 +1,95 @@
+"""Revoked access tokens.
+
+Access tokens are checked without touching the database, so a token
+can only be withdrawn before it expires by listing its id here. Each
+process keeps the list in memory; with REVOCATION_BACKEND=redis,
+revocations are also written to a Redis sorted set (scored by expiry)
+and every process pulls it again at most every
+REVOCATION_SYNC_INTERVAL seconds.
+"""
+import time
+
+from beluga import config
+from beluga.executor import run_blocking
+
+REDIS_KEY = 'beluga:revoked'
+
+
+class RevocationList:
+    """Ids of revoked tokens, kept until the tokens would have expired.
+
+    Args:
+        redis_url (str): Optional Redis to share revocations through.
+        sync_interval (int): Seconds between pulls from Redis.
+    """
+
+    def __init__(self, redis_url=None, sync_interval=5):
+        self.sync_interval = sync_interval
+        self._revoked = {}
+        self._synced_at = 0.0
+        self._client = None
+        if redis_url:
+            import redis
+            self._client = redis.StrictRedis.from_url(redis_url)
+        self.syncs = 0
+        self.rejected = 0
+
+    def is_revoked(self, jti):
+        revoked = jti in self._revoked
+        if revoked:
+            self.rejected += 1
+        return revoked
+
+    async def revoke(self, jti, expires):
+        """Revokes a token id until `expires` (a Unix time)."""
+        self._revoked[jti] = expires
+        self._prune()
+        if self._client is not None:
+            await run_blocking('cache', self._push, jti, expires)
+
+    async def sync(self):
+        """Merges revocations made by other processes, if due."""
+        if self._client is None or \
+                time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = time.monotonic()
+        for jti, expires in await run_blocking('cache', self._pull):
+            self._revoked[jti.decode('utf-8')] = expires
+        self._prune()
+        self.syncs += 1
+
+    def _push(self, jti, expires):
+        self._client.zadd(REDIS_KEY, expires, jti)
+
+    def _pull(self):
+        now = time.time()
+        pipe = self._client.pipeline()
+        pipe.zremrangebyscore(REDIS_KEY, '-inf', now)
+        pipe.zrangebyscore(REDIS_KEY, now, '+inf', withscores=True)
+        return pipe.execute()[1]
+
+    def _prune(self):
+        now = time.time()
+        for jti in [j for j, expires in self._revoked.items() if expires <= now]:
+            del self._revoked[jti]
+
+    def clear(self):
+        self._revoked.clear()
+
+    def stats(self):
+        return {
+            'revoked': len(self._revoked),
+            'rejected': self.rejected,
+            'syncs': self.syncs,
+        }
+
+
+def build_revocations():
+    """Creates the revocation list for the configured backend."""
+    if config.REVOCATION_BACKEND == 'redis':
+        return RevocationList(
+            config.REVOCATION_REDIS_URL, config.REVOCATION_SYNC_INTERVAL)
+    return RevocationList()
+
+
+revocations = build_revocations()
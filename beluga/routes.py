@@ -1,25 +1,56 @@
+import asyncio
 import datetime as dt
 from datetime import timezone as tz
+from functools import partial
 import math
 
 from asyncio import AbstractEventLoop
-
-from geoalchemy2 import WKTElement
+from urllib.parse import urlencode, urlparse, urlunparse
 
 from sanic import Blueprint
 from sanic.exceptions import abort
-from sanic.response import json, raw
+from sanic.response import HTTPResponse, json, raw, stream
 
+import asyncpg
 import ujson
 
-from beluga import auth, config
-from beluga.models import session_scope, Event, Category, User
+from beluga import (
+    aiodb, auth, compression, config, executor, models, queries, ratelimit,
+    versions)
 from beluga.auth import authorized
-from beluga import config
+from beluga.cache import events_cache, events_key, quantize, tiles_covering
+from beluga.catalog import category_catalog
+from beluga.certs import CertsUnavailable, google_certs
+from beluga.revocation import revocations
 
 api = Blueprint('api')
 
 METERS_PER_KILOMETER = 1000.0
+CURSOR_DATE_FMT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+@api.exception(executor.ExecutorSaturated)
+async def executor_saturated(request, exception):
+    # Shed load quickly rather than queueing behind blocking work.
+    return json({'status': 'overloaded'}, 503, headers={
+        'Retry-After': str(config.EXECUTOR_RETRY_AFTER)
+    })
+
+
+@api.exception(CertsUnavailable)
+async def certs_unavailable(request, exception):
+    # Logins can't be verified until Google's certificates load.
+    return json({'status': 'unavailable'}, 503, headers={
+        'Retry-After': str(config.GOOGLE_CERTS_MIN_TTL)
+    })
+
+
+@api.exception(ratelimit.RateLimited, ratelimit.Overloaded)
+async def rate_limited(request, exception):
+    status = 'rate_limited' if exception.status_code == 429 else 'overloaded'
+    return json({'status': status}, exception.status_code, headers={
+        'Retry-After': str(max(1, math.ceil(exception.retry_after)))
+    })
 
 
 # Basic routes.
@@ -28,6 +59,46 @@ async def healthcheck(request):
     return json({"hello": "async world"})
 
 
+@api.route('/metrics', ['GET'])
+@authorized()
+async def metrics_handler(request, user):
+    """
+    @api {get} /metrics Retrieve runtime statistics for this process.
+    @apiName Metrics
+    @apiGroup Operations
+
+    @apiSuccess {Object} db_pool Database connection pool statistics.
+    @apiSuccess {Object} async_db_pool Async database pool statistics.
+    @apiSuccess {Object} executors Queue depth and wait time per
+        blocking-work thread pool.
+    @apiSuccess {Object} events_cache Hit and miss counts of the
+        /events response cache.
+    @apiSuccess {Object} category_catalog Size and reload count of the
+        in-memory category catalog.
+    @apiSuccess {Object} compression Bytes saved and time spent per
+        response encoding.
+    @apiSuccess {Object} rate_limits Admitted and rejected request
+        counts per limiter.
+    @apiSuccess {Object} auth_cache Hit rate of the bearer token cache.
+    @apiSuccess {Object} revocations Size and sync count of the access
+        token revocation list.
+    @apiSuccess {Object} google_certs Fetch counts and remaining
+        lifetime of the cached Google signing certificates.
+    """
+    return json({
+        'db_pool': models.pool_stats(),
+        'async_db_pool': aiodb.pool_stats(),
+        'executors': executor.stats(),
+        'events_cache': events_cache.stats() if events_cache else None,
+        'category_catalog': category_catalog.stats(),
+        'compression': compression.stats(),
+        'rate_limits': ratelimit.stats(),
+        'auth_cache': auth.token_cache.stats(),
+        'revocations': revocations.stats(),
+        'google_certs': google_certs.stats()
+    })
+
+
 # User routes.
 @api.route('/users/self', ['GET'])
 @authorized()
@@ -37,13 +108,18 @@ async def get_self(request, user):
     @apiName Self
     @apiGroup Users
 
+    @apiDescription Served from the claims of the access token, so
+                    profile changes show once the token is refreshed.
+
+    @apiSuccess {Number} id The id of the User.
     @apiSuccess {String} given_name Firstname of the User.
     @apiSuccess {String} surname Lastname of the User.
-    @apiSuccess {Array} logins A list of logins associated with
-        the user.
     @apiSuccess {String} avatar A URL to an avatar image.
     """
-    raise abort(501)
+    if not isinstance(user, auth.AuthUser):
+        raise abort(404)
+
+    return json(user._asdict())
 
 @api.route('/sessions', ['POST'])
 async def create_session(request):
@@ -80,9 +156,32 @@ async def create_session(request):
 
     return json({ 'token': token })
 
+@api.route('/sessions/refresh', ['POST'])
+@authorized()
+async def refresh_session(request, user):
+    """
+    @api {post} /sessions/refresh Exchange an access token for a new one.
+    @apiName RefreshSession
+    @apiGroup Users
+
+    @apiDescription The presented token is revoked and a new token,
+                    carrying the user's current profile and a fresh
+                    expiry, is returned under the key `token`.
+    """
+    if not isinstance(user, auth.AuthUser):
+        raise abort(403)
+
+    token = await auth.rotate(user, request.get('auth_claims'))
+    if token is None:
+        raise abort(403)
+
+    return json({ 'token': token })
+
 # Event routes.
 @api.route('/events', ['GET'])
+@ratelimit.admission()
 @authorized()
+@versions.conditional(versions.EVENTS, versions.CATEGORIES)
 async def event_handler(request, user):
     """
     @api {get} /events Retrieve a listing of events.
@@ -109,108 +208,365 @@ async def event_handler(request, user):
         in RFC 3339 format.
     @apiParam {Number} [limit] The number of events to return
         (default 50).
+    @apiParam {String} [q] Words to search for in event titles and
+        descriptions. Only matching events are returned.
+    @apiParam {String} [sort] Result ordering: `distance` (the default
+        without `q`), `start_time` or `relevance` (the default with
+        `q`, best match first). Ties are broken by event id.
+    @apiParam {String} [cursor] An opaque page position taken from
+        the `next` or `previous` URL of an earlier response.
+    @apiParam {Number} [attendees_limit] The maximum number of attendee
+        profiles to return per event (default 25, at most 100). The
+        full count is returned in `attendee_count`.
+    @apiParam {String} [fields] Comma separated result keys to return,
+        or `summary` for title, location, start_time and id. Every key
+        is returned by default.
+    @apiParam {String} [stream] `true` to stream the response as it is
+        read from the database. Pages larger than 200 events are
+        always streamed.
 
     @apiSuccess {Array} results Event objects.
-    @apiSuccess {String} next URL of the next page of results.
-    @apiSuccess {String} previous URL of the previous page of results.
+    @apiSuccess {Array} results.attendees Attendee profiles, at most
+        `attendees_limit` of them.
+    @apiSuccess {Number} results.attendee_count Total number of attendees.
+    @apiSuccess {String} next URL of the next page of results, or
+        null on the last page.
+    @apiSuccess {String} previous URL of the previous page of results,
+        or null on the first page.
     """
-    start_time = request.args.get('start_time', None)
-    end_time = request.args.get('end_time', None)
-
-    # Parse date query.
-    if start_time:
-        try:
-            start_time = dt.datetime.strptime(start_time, config.DATE_FMT)
-        except ValueError:
-            abort(400, f'start_time ({start_time}) must in format YYYY-MM-DD')
+    catalog = await category_catalog.get(
+        versions.seen(request, versions.CATEGORIES))
+
+    area = parse_area(request.args, catalog)
+    attendees_limit = parse_attendees_limit(request.args)
+    fields = parse_fields(request.args.get('fields', None))
+
+    q = request.args.get('q', '').strip() or None
+
+    sort = request.args.get('sort', 'relevance' if q else 'distance')
+    if sort not in queries.SORT_KEYS:
+        raise abort(400, f'sort must be one of {", ".join(queries.SORT_KEYS)}')
+    if sort == 'relevance' and not q:
+        raise abort(400, 'sort by relevance requires q')
+
+    cursor_token = request.args.get('cursor', None)
+    cursor = decode_cursor(cursor_token, sort) if cursor_token else None
+
+    if area is None:
+        # No such category, so nothing can match.
+        return json({'results': [], 'next': None, 'previous': None})
+    lat, lon, dist, start_time, end_time, category_id, limit = area
+
+    # Nearby centers share a cache entry; the query uses the same
+    # snapped center so cached and fresh responses agree.
+    cache = events_cache
+    if cache is not None:
+        lat, lon = quantize(lat), quantize(lon)
+
+    # One extra row tells us whether another page follows.
+    event_query = queries.events_select(
+        lat, lon, dist, start_time, end_time,
+        category_id=category_id, limit=limit + 1, sort=sort, cursor=cursor,
+        fields=fields, q=q)
+
+    # Big pages are streamed straight from a server-side cursor.
+    # Backward pages are read in reverse, so they are always buffered.
+    backwards = cursor is not None and cursor.backwards
+    streaming = request.args.get('stream') == 'true' or \
+        limit > config.EVENTS_STREAM_MIN_LIMIT
+    if streaming and not backwards:
+        return stream(
+            partial(stream_events, request, event_query, limit, sort,
+                    cursor is not None, attendees_limit, fields,
+                    catalog.by_id),
+            content_type='application/json')
+
+    if cache is not None:
+        tiles = tiles_covering(lat, lon, dist)
+        cache_key = events_key(
+            lat=lat, lon=lon, dist=dist,
+            start_time=start_time.isoformat(), end_time=end_time.isoformat(),
+            category_id=category_id, limit=limit, sort=sort,
+            cursor=cursor_token,
+            attendees_limit=attendees_limit, fields=fields, q=q)
+
+        body = await cache.get(cache_key, tiles)
+        if body is not None:
+            return HTTPResponse(body, content_type='application/json')
+        generations = await cache.generations(tiles)
+
+    events = await aiodb.fetch(event_query)
+
+    has_more = len(events) > limit
+    events = events[:limit]
+    if backwards:
+        events.reverse()
+        has_next, has_previous = True, has_more
     else:
-        start_time = dt.date.min
-    
-    if end_time:
-        try:
-            end_time = dt.datetime.strptime(end_time, config.DATE_FMT)
-        except ValueError:
-            abort(400, f'end_time ({end_time}) must in format YYYY-MM-DD')
-    else:
-        end_time = dt.date.max
+        has_next, has_previous = has_more, cursor is not None
 
-    # TODO: Remove default lat/lon when larger area collected.
-    lat = request.args.get('lat', config.DEFAULT_LAT)
-    lon = request.args.get('lon', config.DEFAULT_LON)
-    radius = request.args.get('radius', config.DEFAULT_RAD.strip('km'))
-    limit = request.args.get('limit', 50)
+    next_url = previous_url = None
+    if events and has_next:
+        next_url = page_url(request, encode_cursor(events[-1], sort, False))
+    if events and has_previous:
+        previous_url = page_url(request, encode_cursor(events[0], sort, True))
 
-    try:
-        dist = float(radius) * METERS_PER_KILOMETER
-        lat = float(lat)
-        lon = float(lon)
-    except ValueError:
-        raise abort(400, 'radius, lat and lon must be numeric')
+    attendees = await resolve_attendees(events, attendees_limit, fields)
+
+    body = ujson.dumps({
+        'results': [
+            format_event(e, attendees, catalog.by_id, fields) for e in events],
+        'next': next_url,
+        'previous': previous_url})
+
+    if cache is not None:
+        await cache.set(cache_key, body, generations)
+
+    return HTTPResponse(body, content_type='application/json')
+
+
+async def stream_events(request, event_query, limit, sort, has_previous,
+                        attendees_limit, fields, categories, response):
+    """Writes an /events page as chunked JSON, pulling rows from a
+    server-side cursor a batch at a time so memory use does not grow
+    with `limit`.
+
+    Attendees are looked up on the cursor's connection, so a stream
+    holds one pooled connection however many batches it writes.
+    """
+    first = last = None
+    written = 0
+    has_next = False
+    batch = []
+    flow = FlowControl(response.transport, config.EVENTS_STREAM_HIGH_WATER)
+
+    async def flush(conn):
+        nonlocal written
+        if not batch:
+            return
+        attendees = await resolve_attendees(
+            batch, attendees_limit, fields, conn)
+        chunk = ','.join(
+            ujson.dumps(format_event(e, attendees, categories, fields))
+            for e in batch)
+        await write_chunk(response, flow, (',' if written else '') + chunk)
+        written += len(batch)
+        batch.clear()
 
     try:
-        limit = int(limit)
-    except ValueError:
-        raise abort(400, f'limit {limit} must be numeric')
+        await write_chunk(response, flow, '{"results":[')
+
+        async with aiodb.get_pool().acquire() as conn:
+            async with conn.transaction():
+                async for e in aiodb.cursor(
+                        event_query, conn,
+                        prefetch=config.EVENTS_STREAM_BATCH):
+                    if written + len(batch) == limit:
+                        has_next = True
+                        break
+                    if first is None:
+                        first = e
+                    last = e
+                    batch.append(e)
+                    if len(batch) >= config.EVENTS_STREAM_BATCH:
+                        await flush(conn)
+                await flush(conn)
+
+        next_url = previous_url = None
+        if last is not None and has_next:
+            next_url = page_url(request, encode_cursor(last, sort, False))
+        if first is not None and has_previous:
+            previous_url = page_url(request, encode_cursor(first, sort, True))
+
+        await write_chunk(response, flow, '],"next":{},"previous":{}}}'.format(
+            ujson.dumps(next_url), ujson.dumps(previous_url)))
+    finally:
+        flow.release()
+
+
+class FlowControl(asyncio.Protocol):
+    """Sits in front of a connection's Sanic protocol while a response
+    streams, passing everything through. Sanic 0.6 ignores the
+    transport's pause_writing/resume_writing, so this keeps track of
+    them itself and lets the writer wait for a slow client.
+
+    Args:
+        transport: The connection's transport.
+        high (int): Bytes buffered before writing pauses. It resumes
+            once the buffer is down to a quarter of that.
+    """
+
+    def __init__(self, transport, high):
+        self.transport = transport
+        self.protocol = transport.get_protocol()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        transport.set_protocol(self)
+        transport.set_write_buffer_limits(high=high)
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    def data_received(self, data):
+        self.protocol.data_received(data)
+
+    def eof_received(self):
+        return self.protocol.eof_received()
+
+    def connection_lost(self, exc):
+        self._writable.set()
+        self.protocol.connection_lost(exc)
+
+    async def drain(self):
+        """Waits until the write buffer is below its low-water mark.
+
+        Raises:
+            ConnectionError: The client went away.
+        """
+        await self._writable.wait()
+        if self.transport.is_closing():
+            raise ConnectionError('client went away mid-stream')
+
+    def release(self):
+        """Hands the connection back to Sanic's protocol."""
+        if self.transport.get_protocol() is self:
+            self.transport.set_protocol(self.protocol)
+
+
+async def write_chunk(response, flow, data):
+    """Writes to a streaming response, waiting for a slow client to
+    drain the socket buffer before more rows are read.
+    """
+    response.write(data)
+    await flow.drain()
+
 
-    category = request.args.get('category', None)
-
-    # Center point of search area from request.
-    center_point = WKTElement(f"POINT({lon} {lat})")
-    distance_col = Event.location.ST_Distance(center_point).label('distance')
-
-    with session_scope() as db_session:
-        cols = [
-            Event.id,
-            Event.title,
-            Event.description_html,
-            Event.description_text,
-            Event.start_time,
-            Event.end_time,
-            Event.attendees,
-            Event.location.ST_AsGeoJSON().label("location_json"),
-            Category.name.label('category'),
-            distance_col
-        ]
-
-        # Build SQL query.
-        event_query = (
-            db_session
-            .query(*cols)
-            .filter(Event.start_time >= start_time)
-            .filter(Event.end_time <= end_time)
-            .join(Category, Event.category_id == Category.category_id)
-            .filter(Event.location.ST_DWithin(center_point, dist))
-            .order_by(distance_col.asc())
-        )
-
-        if category:
-            event_query = event_query.filter(Category.name == category)
-
-        attendee_cols = [
-            User.given_name,
-            User.surname,
-            User.avatar
-        ]
-
-        # Format according to API spec, not DB schema
-        return json({'results': [{
-                'title': e.title,
-                'description_html': e.description_html,
-                'description_text': e.description_text,
-                'location': geojson_to_latlon(e.location_json),
-                'start_time': e.start_time.astimezone(tz.utc).isoformat(),
-                'end_time': e.end_time.astimezone(tz.utc).isoformat(),
-                'distance': e.distance,
-                'category': e.category,
-                'id': e.id,
-                'attendees': map(lambda u: {
-                        'given_name': u.given_name,
-                        'surname': u.surname,
-                        'avatar': u.avatar
-                    }, map(lambda uid: db_session.query(*attendee_cols) \
-                            .filter(User.id == uid).first(),
-                        (e.attendees or [])))
-            } for e in event_query.limit(limit)]})
+async def resolve_attendees(events, attendees_limit, fields, conn=None):
+    """Attendee counts and profiles for a batch of event rows, in two
+    queries however many events and attendees there are. Neither query
+    runs unless `fields` asks for it. They run on `conn` if given.
+    """
+    if 'attendee_count' not in fields and 'attendees' not in fields:
+        return {}
+    if 'attendees' not in fields:
+        attendees_limit = 0
+
+    attendee_rows = await aiodb.fetch(queries.attendee_ids_select(
+        [e['id'] for e in events], attendees_limit), conn)
+    ids = {r['event_id']: r['user_ids'] for r in attendee_rows}
+    counts = {r['event_id']: r['total'] for r in attendee_rows}
+    profiles = await attendee_profiles(ids.values(), conn)
+    return {
+        event_id: (counts[event_id], [
+            profiles[uid] for uid in user_ids if uid in profiles])
+        for event_id, user_ids in ids.items()
+    }
+
+
+def format_event(e, attendees, categories, fields=queries.EVENT_FIELDS):
+    """Format according to API spec, not DB schema"""
+    count, profiles = attendees.get(e['id'], (0, []))
+    formatters = {
+        'title': lambda: e['title'],
+        'description_html': lambda: e['description_html'],
+        'description_text': lambda: e['description_text'],
+        'location': lambda: {'lat': e['latitude'], 'lon': e['longitude']},
+        'start_time': lambda: e['start_time'].astimezone(tz.utc).isoformat(),
+        'end_time': lambda: e['end_time'].astimezone(tz.utc).isoformat(),
+        'distance': lambda: e['distance'],
+        'category': lambda: categories.get(e['category_id']),
+        'id': lambda: e['id'],
+        'attendees': lambda: profiles,
+        'attendee_count': lambda: count
+    }
+    return {field: formatters[field]() for field in fields}
+
+
+async def attendee_profiles(id_lists, conn=None):
+    """Resolves public attendee profiles for a whole page of events
+    in a single query, on `conn` if given. Returns a dict of user id
+    to profile.
+    """
+    user_ids = {uid for ids in id_lists for uid in ids}
+    if not user_ids:
+        return {}
+
+    rows = await aiodb.fetch(
+        queries.attendees_select(list(user_ids)), conn)
+    return {
+        r['id']: {
+            'given_name': r['given_name'],
+            'surname': r['surname'],
+            'avatar': r['avatar']
+        } for r in rows
+    }
+
+
+@api.route('/events/batch', ['POST'])
+@ratelimit.admission()
+@authorized()
+async def batch_event_handler(request, user):
+    """
+    @api {post} /events/batch Retrieve events for several areas at once.
+    @apiName BatchEvents
+    @apiGroup Events
+
+    @apiDescription Runs up to 20 event queries in a single database
+                    round trip. Each query takes the `lat`, `lon`,
+                    `radius`, `start_time`, `end_time`, `category` and
+                    `limit` parameters of GET /events and is ordered
+                    by distance.
+
+    @apiParam {Array} queries Query objects.
+    @apiParam {String} [fields] As for GET /events.
+    @apiParam {Number} [attendees_limit] As for GET /events.
+
+    @apiSuccess {Array} results One object per query, in order.
+    @apiSuccess {Array} results.results Event objects for that query.
+    """
+    body = request.json
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+        raise abort(400, 'body must be an object with a queries list')
+
+    area_params = body['queries']
+    if not area_params:
+        raise abort(400, 'queries must not be empty')
+    if len(area_params) > config.EVENTS_BATCH_MAX_QUERIES:
+        raise abort(400, 'at most {} queries are allowed'.format(
+            config.EVENTS_BATCH_MAX_QUERIES))
+    if not all(isinstance(params, dict) for params in area_params):
+        raise abort(400, 'queries must be objects')
+
+    category_version = await versions.current(versions.CATEGORIES)
+    catalog = await category_catalog.get(category_version[versions.CATEGORIES])
+
+    areas = [parse_area(params, catalog) for params in area_params]
+    fields = parse_fields(body.get('fields'))
+    attendees_limit = parse_attendees_limit(body)
+
+    # Areas naming an unknown category match nothing and are not sent.
+    queried = [
+        (i, area._replace(
+            limit=max(0, min(area.limit, config.EVENTS_BATCH_MAX_LIMIT))))
+        for i, area in enumerate(areas) if area is not None]
+
+    events = []
+    if queried:
+        events = await aiodb.fetch(queries.areas_events_select(
+            [area for _, area in queried], fields))
+    attendees = await resolve_attendees(events, attendees_limit, fields)
+
+    results = [[] for _ in areas]
+    for e in events:
+        results[queried[e['area']][0]].append(
+            format_event(e, attendees, catalog.by_id, fields))
+
+    return HTTPResponse(
+        ujson.dumps({'results': [{'results': r} for r in results]}),
+        content_type='application/json')
 
 
 @api.route('/events/<uuid>/rsvp', ['POST', 'DELETE'])
@@ -243,70 +599,168 @@ async def rsvp_handler(request, user, uuid):
 
     @apiParam {Number} uuid Event unique ID.
     """
-    # Retrieve requested event
-    with session_scope() as db_session:
-        query = db_session.query(Event).filter(Event.id == uuid)
-        event = query.one_or_none()
+    try:
+        event_id = int(uuid)
+    except ValueError:
+        raise abort(404, "the event was not found")
 
-        if event is None:
+    # Each RSVP is a single idempotent statement on event_attendees;
+    # the events row itself is never locked or rewritten.
+    if request.method == "POST":
+        try:
+            status = await aiodb.execute(
+                queries.rsvp_insert(event_id, user.id))
+        except asyncpg.ForeignKeyViolationError:
             raise abort(404, "the event was not found")
+        changed = status != 'INSERT 0 0'
+    elif request.method == "DELETE":
+        status = await aiodb.execute(queries.rsvp_delete(event_id, user.id))
+        changed = status != 'DELETE 0'
+        if not changed and \
+                not await aiodb.fetchval(queries.event_exists(event_id)):
+            raise abort(404, "the event was not found")
+    else:
+        raise abort(500)
 
-        # Acquire current attendee list
-        if event.attendees is None:
-            attendees = []
-        else:
-            attendees = event.attendees
-
-        # Update attendee list
-        if request.method == "POST":
-            attendees = await post_rsvp(user, attendees)
-        elif request.method == "DELETE":
-            attendees = await delete_rsvp(user, attendees)
-        else:
-            raise abort(500)
-
-        # Record update in database
-        query.update({Event.attendees: attendees})
+    # Attendee lists are part of cached /events responses.
+    if changed and events_cache is not None:
+        point = await aiodb.fetchrow(queries.event_point(event_id))
+        if point is not None:
+            await events_cache.invalidate_async(
+                [(point['latitude'], point['longitude'])])
+    if changed:
+        await versions.bump_async(versions.EVENTS)
 
     return raw(b'', status=204)
 
 # Helper functions
-async def delete_rsvp(user, attendees):
-    """DELETE RSVP handler.
-    Sets the authorized user's RSVP status
-    on the event specified by `uuid` to False.
-    """
+def encode_cursor(event, sort, backwards):
+    """Signs the keyset position of an event row as an opaque token."""
+    if sort in ('distance', 'relevance'):
+        # repr() round-trips the float exactly.
+        value = repr(event[sort])
+    else:
+        value = event['start_time'].strftime(CURSOR_DATE_FMT)
+
+    return auth.sign(auth.CURSOR_TOKEN_TYPE, {
+        'sort': sort,
+        'value': value,
+        'id': event['id'],
+        'backwards': backwards
+    })
+
+def decode_cursor(token, sort):
+    """Verifies a cursor token and returns its queries.Cursor."""
     try:
-        attendees.remove(user.id)
-    except ValueError:
-        # The user wasn't attending the event anyway, so it doesn't matter
-        pass
-    return attendees
-
-async def post_rsvp(user, attendees):
-    """POST RSVP handler.
-    Sets the authorized user's RSVP status
-    on the event specified by `uuid` to True.
+        state = auth.unsign(auth.CURSOR_TOKEN_TYPE, token)
+        if state['sort'] != sort:
+            raise ValueError('cursor was issued for another sort order')
+
+        if sort in ('distance', 'relevance'):
+            value = float(state['value'])
+        else:
+            value = dt.datetime.strptime(state['value'], CURSOR_DATE_FMT)
+
+        return queries.Cursor(value, int(state['id']), bool(state['backwards']))
+    except Exception:
+        raise abort(400, 'cursor is invalid')
+
+def parse_area(params, catalog):
+    """Reads the search area, time window, category and limit of an
+    events query from request args or a batch query object. Returns
+    None if the category is not in `catalog`, as nothing can match.
     """
+    start_time = params.get('start_time', None)
+    end_time = params.get('end_time', None)
+
+    # Parse date query.
+    if start_time:
+        try:
+            start_time = dt.datetime.strptime(start_time, config.DATE_FMT)
+        except (TypeError, ValueError):
+            abort(400, f'start_time ({start_time}) must in format YYYY-MM-DD')
+    else:
+        start_time = dt.datetime.min
+
+    if end_time:
+        try:
+            end_time = dt.datetime.strptime(end_time, config.DATE_FMT)
+        except (TypeError, ValueError):
+            abort(400, f'end_time ({end_time}) must in format YYYY-MM-DD')
+    else:
+        end_time = dt.datetime.max
+
+    # TODO: Remove default lat/lon when larger area collected.
+    lat = params.get('lat', config.DEFAULT_LAT)
+    lon = params.get('lon', config.DEFAULT_LON)
+    radius = params.get('radius', config.DEFAULT_RAD.strip('km'))
+    limit = params.get('limit', 50)
+
     try:
-        attendees.index(user.id)
-    except ValueError:
-        # The user wasn't attending the event, so we need to add them
-        attendees.append(user.id)
-    return attendees
+        dist = float(radius) * METERS_PER_KILOMETER
+        lat = float(lat)
+        lon = float(lon)
+    except (TypeError, ValueError):
+        raise abort(400, 'radius, lat and lon must be numeric')
 
-def geojson_to_latlon(geojson):
-    """Convert from GeoJSON to API lat/lon format"""
-    geo = ujson.loads(geojson)
-    assert geo["type"] == "Point"
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise abort(400, f'limit {limit} must be numeric')
 
-    return {
-        'lat': geo['coordinates'][1],
-        'lon': geo['coordinates'][0]
-    }
+    category = params.get('category', None)
+    category_id = None
+    if category:
+        category_id = catalog.ids.get(category)
+        if category_id is None:
+            return None
+
+    return queries.Area(
+        lat, lon, dist, start_time, end_time, category_id, limit)
+
+def parse_attendees_limit(params):
+    """Reads `attendees_limit`, clamped to ATTENDEES_LIMIT_MAX."""
+    attendees_limit = params.get(
+        'attendees_limit', config.ATTENDEES_LIMIT_DEFAULT)
+    try:
+        attendees_limit = int(attendees_limit)
+    except (TypeError, ValueError):
+        raise abort(400, f'attendees_limit {attendees_limit} must be numeric')
+    return max(0, min(attendees_limit, config.ATTENDEES_LIMIT_MAX))
+
+def parse_fields(value):
+    """Resolves the `fields` parameter to a tuple of result keys in
+    response order. `summary` may be combined with other keys.
+    """
+    if not value:
+        return queries.EVENT_FIELDS
+
+    if not isinstance(value, str):
+        raise abort(400, 'fields must be a comma separated string')
+
+    requested = set()
+    for field in value.split(','):
+        field = field.strip()
+        if field == 'summary':
+            requested.update(queries.SUMMARY_FIELDS)
+        elif field in queries.EVENT_FIELDS:
+            requested.add(field)
+        elif field:
+            raise abort(400, f'unknown field {field}')
+
+    return tuple(f for f in queries.EVENT_FIELDS if f in requested)
+
+def page_url(request, cursor):
+    """The URL of this request, positioned at `cursor`."""
+    args = [(k, v) for k, vs in request.args.items() if k != 'cursor'
+            for v in vs]
+    args.append(('cursor', cursor))
+    return urlunparse(
+        urlparse(request.url)._replace(query=urlencode(args)))
 
 @authorized()
 @api.route('/categories', ['GET'])
+@versions.conditional(versions.CATEGORIES)
 async def categories_handler(request):
     """
     @api {post} /categories Get event categories.
@@ -316,9 +770,8 @@ async def categories_handler(request):
     @apiName CategoryList
     @apiGroup Categories
     """
-    with session_scope() as session:
-        return json({
-            "results": [
-                c.name for c in session.query(Category)
-            ]
-        })
+    catalog = await category_catalog.get(
+        versions.seen(request, versions.CATEGORIES))
+    return json({
+        "results": catalog.names
+    })
@@ -0,0 +1,115 @@
+"""Dataset versions for conditional GETs.
+
+Every committed write that changes what GET /events or /categories
+returns bumps a Postgres sequence. Handlers wrapped in `conditional()`
+read the current values, which touches no table, and send them as a
+strong ETag, answering a matching If-None-Match with 304.
+
+Writers bump after committing and after invalidating `events_cache`,
+so a reader that sees a new version never gets an older body.
+"""
+from functools import wraps
+
+import sqlalchemy as sa
+from sanic.response import HTTPResponse
+
+from beluga import aiodb
+from beluga.models import categories_version_seq, events_version_seq
+
+EVENTS = 'events'
+CATEGORIES = 'categories'
+
+SEQUENCES = {
+    EVENTS: events_version_seq,
+    CATEGORIES: categories_version_seq,
+}
+
+
+def versions_select(names):
+    """The current value of each named version. A sequence that was
+    never advanced reads 0: its last_value is already its start.
+    """
+    return sa.select([
+        sa.literal_column(
+            f'(SELECT CASE WHEN is_called THEN last_value ELSE 0 END '
+            f'FROM {SEQUENCES[name].name})',
+            type_=sa.BigInteger).label(name)
+        for name in names
+    ])
+
+
+def bump_select(names):
+    """Advances each named version."""
+    return sa.select([SEQUENCES[name].next_value() for name in names])
+
+
+def bump(session, *names):
+    """Advances versions from a blocking session. Call once the change
+    is committed.
+    """
+    session.execute(bump_select(names))
+
+
+async def bump_async(*names, conn=None):
+    """Advances versions from a request handler."""
+    await aiodb.execute(bump_select(names), conn)
+
+
+async def current(*names):
+    """Reads the named versions."""
+    return dict(await aiodb.fetchrow(versions_select(names)))
+
+
+def etag(versions, names):
+    return '"{}"'.format('.'.join(
+        '{}{}'.format(name[0], versions[name]) for name in names))
+
+
+def if_none_match(request):
+    """The entity tags listed in a request's If-None-Match header."""
+    header = request.headers.get('If-None-Match', '')
+    tags = set()
+    for tag in header.split(','):
+        tag = tag.strip()
+        tags.add(tag[2:] if tag.startswith('W/') else tag)
+    return tags
+
+
+def seen(request, name):
+    """The version `conditional()` read for this request, or None."""
+    return request.get('versions', {}).get(name)
+
+
+def conditional(*names):
+    """A decorator tagging responses with the named dataset versions
+    and answering unchanged requests with 304 Not Modified.
+
+    Example:
+
+        @api.route('/categories', ['GET'])
+        @conditional(versions.CATEGORIES)
+        async def categories_handler(request):
+            ...
+
+    NOTE: This decorator must come after @authorized(), so that
+          unauthorized requests learn nothing from the tag.
+    """
+    def decorator(f):
+        @wraps(f)
+        async def decorated_function(request, *args, **kwargs):
+            # Read before building the body, so the body is never
+            # older than its tag.
+            request['versions'] = await current(*names)
+            tag = etag(request['versions'], names)
+
+            if_none = if_none_match(request)
+            if tag in if_none or '*' in if_none:
+                return HTTPResponse(status=304, headers={'ETag': tag})
+
+            response = await f(request, *args, **kwargs)
+            if response.status == 200:
+                response.headers['ETag'] = tag
+            return response
+
+        return decorated_function
+    return decorator
@@ -1,18 +1,63 @@
+import time
+from unittest.mock import patch
+
 from beluga import app
+from beluga.auth import (
+    ACCESS_TOKEN_TYPE, AuthUser, TokenCache, issue_access_token,
+    read_access_token, sign, unsign_typed
+)
+from beluga.certs import google_certs
+from beluga.models import User, session_scope
+from beluga.revocation import RevocationList, revocations
 from tests.utils import (
+    GOOGLE_CERT,
+    google_token,
     mock_users,
-    magic_bearer_token
+    new_db,
+    magic_bearer_token,
+    run
 )
 
-def test_bad_google_session():
+def test_bad_google_session(monkeypatch):
+    async def certs():
+        with open('tests/fixtures/google_cert.pem') as f:
+            return {'k1': f.read()}
+    # Stand in for Google's certificate endpoint.
+    monkeypatch.setattr(google_certs, 'get', certs)
+
     _, response = app.test_client.post('/sessions', json={
         'service': 'google',
         'token': 'eyJhbGciOiJSUzI1NiIsImtpZCI6Ijc3ZDRlZDYyZWUyMWQxNTdlOGEyMzdiN2RiM2NiZDhmN2FhZmFiMmUifQ.eyJhenAiOiIxNDg1Njc5ODY0NzUtaGpramlobnFuNTQ2MDMyMzV1NHJoaWxoNTRvc2NsY2MuYXBwcy5nb29nbGV1c2VyY29udGVudC5jb20iLCJhdWQiOiIxNDg1Njc5ODY0NzUtaGpramlobnFuNTQ2MDMyMzV1NHJoaWxoNTRvc2NsY2MuYXBwcy5nb29nbGV1c2VyY29udGVudC5jb20iLCJzdWIiOiIxMDcwNDAzMDcwNDU2NDUxODc4ODUiLCJlbWFpbCI6ImpvcmRhbjkzNjRAZ21haWwuY29tIiwiZW1haWxfdmVyaWZpZWQiOnRydWUsImF0X2hhc2giOiJNX1FLUXhQQzZxbEZxUVAtcEJpYnlnIiwiaXNzIjoiaHR0cHM6Ly9hY2NvdW50cy5nb29nbGUuY29tIiwiaWF0IjoxNTA5OTMxNDA1LCJleHAiOjE1MDk5MzUwMDUsIm5hbWUiOiJKb3JkYW4gSmVmZnJpZXMiLCJwaWN0dXJlIjoiaHR0cHM6Ly9saDMuZ29vZ2xldXNlcmNvbnRlbnQuY29tLy1ScG1DNnJNMXJWcy9BQUFBQUFBQUFBSS9BQUFBQUFBQUF5dy9IeVQtNFhvbWZLcy9zOTYtYy9waG90by5qcGciLCJnaXZlbl9uYW1lIjoiSm9yZGFuIiwiZmFtaWx5X25hbWUiOiJKZWZmcmllcyIsImxvY2FsZSI6ImVuIn0.CFGeOxoE_CVowIGsHpYstB7no4MIbdFzu9XRM74os0QVGo1NKetXzIt7PTUbGutZkJCScuxJcXKdhOZDJKQrPdBo_Szw26WaKo_fYD7riE6yYakkjl5Z9MIqPiki6aJX6ktXcu1fdb77rtcsRTQ1AymuNoX8AfKdSjyotCi1WSlUXOt6y59gI-KWG9OmbXUEbXp1n0VV5iUhPb9gSQVFFD98JC4A3qGUDz0d9VQosugL42sti4J-VINCNDuG-IFUJ5KHisyCLGCGGzcZPqXDROrOZfeCu58bgxeHsKbOOqG4SAXJQ5xg7TPMkCkaoNY20wEQSZA1GFV_i8fv_4gKYA'
     })
 
-    # This should fail because the token has expired
+    # This should fail: the token has expired and its key is unknown
     assert response.status == 403
 
+
+@new_db()
+def test_google_login_twice_is_one_user():
+    async def certs():
+        return {'k1': GOOGLE_CERT}
+    token = google_token(given_name='Ada', family_name='Lovelace')
+
+    user_ids = []
+    with patch.object(google_certs, 'get', certs):
+        for _ in range(2):
+            _, response = app.test_client.post('/sessions', json={
+                'service': 'google',
+                'token': token
+            })
+            assert response.status == 200
+            _, claims = unsign_typed(response.json['token'])
+            user_ids.append(claims['sub'])
+
+    # The second login finds the first one's row.
+    assert user_ids[0] == user_ids[1]
+    with session_scope() as session:
+        users = [(u.id, u.login_uid) for u in session.query(User)]
+    assert users == [(user_ids[0], '1234')]
+
+
 @mock_users()
 def test_good_bearer_token():
     _, response = app.test_client.get('/users/self', headers={
@@ -20,8 +65,13 @@ def test_good_bearer_token():
         'Authorization': 'Bearer {}'.format(magic_bearer_token)
     })
 
-    # We should be told that this functionality is unimplemented
-    assert response.status == 501
+    assert response.status == 200
+    assert response.json == {
+        'id': 1,
+        'given_name': 'Jeffrey Lamar',
+        'surname': 'Williams',
+        'avatar': None
+    }
 
 def test_bad_bearer_token():
     _, response = app.test_client.get('/users/self', headers={
@@ -37,4 +87,106 @@ def test_empty_bearer_token():
     })
 
     # We should be told we aren't allowed
-    assert response.status == 403
\ No newline at end of file
+    assert response.status == 403
+
+
+ALICE = AuthUser(1, 'alice', 'a', None)
+BOB = AuthUser(2, 'bob', 'b', None)
+
+
+def test_token_cache_hits_and_expires():
+    cache = TokenCache(max_entries=10, ttl=0.05)
+    assert cache.get('t1') is None
+    cache.set('t1', ALICE)
+    assert cache.get('t1') == ALICE
+
+    time.sleep(0.06)
+    assert cache.get('t1') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+
+def test_token_cache_evicts_least_recent():
+    cache = TokenCache(max_entries=2, ttl=60)
+    cache.set('t1', ALICE)
+    cache.set('t2', BOB)
+    cache.get('t1')
+    cache.set('t3', BOB)
+    assert cache.get('t2') is None
+    assert cache.get('t1') == ALICE
+
+
+def test_token_cache_invalidates_user():
+    cache = TokenCache(max_entries=10, ttl=60)
+    cache.set('t1', ALICE)
+    cache.set('t2', ALICE)
+    cache.set('t3', BOB)
+    cache.invalidate_user(ALICE.id)
+    assert cache.get('t1') is None
+    assert cache.get('t2') is None
+    assert cache.get('t3') == BOB
+
+
+def bearer(token):
+    return {'Authorization': 'Bearer {}'.format(token)}
+
+
+@mock_users()
+def test_access_token_serves_self():
+    token = issue_access_token(ALICE)
+    _, response = app.test_client.get('/users/self', headers=bearer(token))
+
+    assert response.status == 200
+    assert response.json['given_name'] == 'alice'
+
+
+def test_expired_access_token():
+    _, claims = unsign_typed(issue_access_token(ALICE))
+    claims['exp'] = int(time.time()) - 1
+    token = sign(ACCESS_TOKEN_TYPE, claims)
+
+    _, response = app.test_client.get('/users/self', headers=bearer(token))
+    assert response.status == 403
+
+
+def test_revoked_access_token():
+    token = issue_access_token(ALICE)
+    _, claims = unsign_typed(token)
+    assert read_access_token(claims) == ALICE
+
+    run(revocations.revoke(claims['jti'], claims['exp']))
+    try:
+        assert read_access_token(claims) is None
+        _, response = app.test_client.get(
+            '/users/self', headers=bearer(token))
+        assert response.status == 403
+    finally:
+        revocations.clear()
+
+
+@mock_users()
+def test_refresh_rotates_token():
+    old = issue_access_token(AuthUser(1, 'stale', 'name', None))
+    _, response = app.test_client.post(
+        '/sessions/refresh', headers=bearer(old))
+    assert response.status == 200
+    new = response.json['token']
+
+    try:
+        _, response = app.test_client.get('/users/self', headers=bearer(new))
+        assert response.json['given_name'] == 'Jeffrey Lamar'
+
+        _, response = app.test_client.get('/users/self', headers=bearer(old))
+        assert response.status == 403
+    finally:
+        revocations.clear()
+
+
+def test_revocation_list_forgets_expired():
+    revoked = RevocationList()
+    run(revoked.revoke('a', time.time() + 60))
+    run(revoked.revoke('b', time.time() - 1))
+
+    assert revoked.is_revoked('a')
+    assert not revoked.is_revoked('b')
+    assert revoked.stats()['revoked'] == 1
@@ -0,0 +1,82 @@
+from unittest.mock import patch
+
+from beluga.cache import (
+    MemoryBackend,
+    TileCache,
+    tile_of,
+    tiles_covering
+)
+from tests.utils import run
+
+
+def new_cache(max_entries=10, ttl=60):
+    return TileCache(MemoryBackend(max_entries), ttl)
+
+
+def test_tiles_cover_search_circle():
+    tiles = tiles_covering(49.241, -123.1073, 10000)
+    assert tile_of(49.241, -123.1073) in tiles
+    assert tile_of(49.241 + 0.08, -123.1073) in tiles
+    assert tile_of(49.241, -123.1073 - 0.13) in tiles
+    assert tile_of(49.241 + 0.5, -123.1073) not in tiles
+
+
+def test_huge_radius_falls_back_to_global():
+    assert tiles_covering(49.241, -123.1073, 2000000) is None
+
+
+def test_hit_then_invalidated_by_tile():
+    cache = new_cache()
+    tiles = tiles_covering(49.241, -123.1073, 10000)
+
+    generations = run(cache.generations(tiles))
+    run(cache.set('k', '{"results":[]}', generations))
+    assert run(cache.get('k', tiles)) == '{"results":[]}'
+
+    # An event loaded far away leaves the entry alone.
+    cache.invalidate([(-49.0, 123.0)])
+    assert run(cache.get('k', tiles)) == '{"results":[]}'
+
+    # One loaded inside the search area expires it.
+    cache.invalidate([(49.25, -123.1)])
+    assert run(cache.get('k', tiles)) is None
+
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['stale'] == 1
+
+
+def test_wide_search_invalidated_by_any_tile():
+    cache = new_cache()
+    run(cache.set('k', 'body', run(cache.generations(None))))
+    cache.invalidate([(-49.0, 123.0)])
+    assert run(cache.get('k', None)) is None
+
+
+def test_invalidate_all():
+    cache = new_cache()
+    run(cache.set('k', 'body', run(cache.generations(None))))
+    cache.invalidate_all()
+    assert run(cache.get('k', None)) is None
+
+
+def test_lru_eviction():
+    cache = new_cache(max_entries=2)
+    generations = run(cache.generations(None))
+    run(cache.set('a', 'A', generations))
+    run(cache.set('b', 'B', generations))
+    run(cache.get('a', None))
+    run(cache.set('c', 'C', generations))
+
+    assert run(cache.get('a', None)) == 'A'
+    assert run(cache.get('b', None)) is None
+    assert run(cache.get('c', None)) == 'C'
+
+
+def test_ttl_expiry():
+    cache = new_cache(ttl=10)
+    run(cache.set('k', 'body', run(cache.generations(None))))
+
+    with patch('beluga.cache.time.monotonic', return_value=1e12):
+        assert run(cache.get('k', None)) is None
@@ -0,0 +1,117 @@
+import asyncio
+
+from aiohttp import web
+import pytest
+
+from beluga.auth import verify_google_token
+from beluga.certs import CertCache, CertsUnavailable, cache_lifetime
+from tests.utils import GOOGLE_CERT, google_token, run
+
+
+class KeyServer:
+    """A local stand-in for Google's certificate endpoint."""
+
+    def __init__(self, max_age=3600):
+        self.max_age = max_age
+        self.status = 200
+        self.requests = 0
+
+    async def certs(self, request):
+        self.requests += 1
+        if self.status != 200:
+            return web.Response(status=self.status)
+        return web.json_response({'k1': GOOGLE_CERT}, headers={
+            'Cache-Control': 'public, max-age={}'.format(self.max_age)
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/certs', self.certs)
+        self.handler = app.make_handler()
+        self.server = await asyncio.get_event_loop().create_server(
+            self.handler, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return 'http://127.0.0.1:{}/certs'.format(port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.handler.shutdown()
+
+
+def test_cache_lifetime():
+    assert cache_lifetime({'Cache-Control': 'public, max-age=100'}, 5) == 100
+    assert cache_lifetime(
+        {'Cache-Control': 'max-age=100', 'Age': '30'}, 5) == 70
+    assert cache_lifetime({}, 5) == 5
+
+
+def test_certs_cached_for_max_age():
+    server = KeyServer()
+
+    async def scenario():
+        certs = CertCache(await server.start(), refresh_before=60)
+        try:
+            assert await certs.get() == {'k1': GOOGLE_CERT}
+            assert await certs.get() == {'k1': GOOGLE_CERT}
+        finally:
+            await server.stop()
+        return certs
+
+    certs = run(scenario())
+    assert server.requests == 1
+    assert certs.stats()['keys'] == 1
+    assert certs.stats()['expires_in'] > 3500
+
+
+def test_certs_refresh_in_background():
+    server = KeyServer()
+
+    async def scenario():
+        certs = CertCache(await server.start(), refresh_before=7200)
+        try:
+            await certs.get()
+            # Due for refresh, but still valid: served without waiting.
+            assert await certs.get() == {'k1': GOOGLE_CERT}
+            assert server.requests == 1
+            await certs.refresh()
+        finally:
+            await server.stop()
+
+    run(scenario())
+    assert server.requests == 2
+
+
+def test_stale_certs_kept_when_fetch_fails():
+    server = KeyServer(max_age=0)
+
+    async def scenario():
+        certs = CertCache(await server.start(), min_ttl=0)
+        try:
+            await certs.get()
+            server.status = 500
+            assert await certs.get() == {'k1': GOOGLE_CERT}
+        finally:
+            await server.stop()
+        return certs
+
+    certs = run(scenario())
+    assert certs.stats()['failures'] == 1
+
+
+def test_certs_unavailable():
+    certs = CertCache('http://127.0.0.1:1/certs', timeout=1)
+    with pytest.raises(CertsUnavailable):
+        run(certs.get())
+
+
+def test_verify_google_token():
+    claims = verify_google_token(google_token(), {'k1': GOOGLE_CERT})
+    assert claims['sub'] == '1234'
+
+    with pytest.raises(ValueError):
+        verify_google_token(google_token(aud='someone-else'), {'k1': GOOGLE_CERT})
+    with pytest.raises(ValueError):
+        verify_google_token(google_token(iss='evil.com'), {'k1': GOOGLE_CERT})
+    with pytest.raises(ValueError):
+        verify_google_token(google_token(), {'k2': GOOGLE_CERT})
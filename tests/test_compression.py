@@ -0,0 +1,46 @@
+import gzip
+
+import ujson as json
+
+from beluga import app
+from beluga.compression import GzipCodec, negotiate
+from tests.utils import mock_events, new_db
+
+GZIP = GzipCodec(6)
+CODECS = [GZIP]
+
+
+def test_negotiate():
+    assert negotiate('gzip, deflate', CODECS) is GZIP
+    assert negotiate('*', CODECS) is GZIP
+    assert negotiate('gzip;q=0', CODECS) is None
+    assert negotiate('deflate', CODECS) is None
+    assert negotiate('', CODECS) is None
+
+
+def test_gzip_round_trip():
+    body = json.dumps({'results': ['<p>Lots of HTML</p>'] * 100}).encode()
+    assert gzip.decompress(GZIP.compress(body)) == body
+
+    compress, finish = GZIP.stream()
+    chunks = [compress(body[:100]), compress(body[100:]), finish()]
+    assert gzip.decompress(b''.join(chunks)) == body
+
+
+@new_db()
+@mock_events()
+def test_events_are_compressed():
+    headers = {
+        'Authorization': 'Bearer GOOD_TEST_TOKEN',
+        'Accept-Encoding': 'gzip'
+    }
+    _, plain = app.test_client.get(
+        '/events', headers={'Authorization': 'Bearer GOOD_TEST_TOKEN'})
+    assert 'Content-Encoding' not in plain.headers
+
+    for url in ('/events', '/events?stream=true'):
+        _, response = app.test_client.get(url, headers=headers)
+        assert response.status == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'].startswith('W/')
+        assert response.json['results'] == plain.json['results']
@@ -2,9 +2,15 @@ import datetime as dt
 
 from geoalchemy2 import WKTElement
 
-from beluga.models import Event, session_scope
+from beluga import config, queries, versions
+from beluga.aiodb import compile_query
+from beluga.models import (
+    Event, get_engine, pool_stats, refresh_upcoming_index, session_scope)
 from tests.utils import new_db, add_db_categories
 
+# Enough rows, spread over a wide area, for the planner to prefer indexes.
+SEED_EVENTS = 20000
+
 
 @new_db()
 @add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
@@ -24,3 +30,194 @@ def test_write_event():
         result = db_session.query(Event).one()
 
         assert result == event
+
+
+def test_session_scope_reuses_engine():
+    with session_scope() as db_session:
+        first = db_session.get_bind()
+    with session_scope() as db_session:
+        second = db_session.get_bind()
+
+    assert first is second
+    assert first is get_engine()
+
+
+def test_pool_stats_count_checkouts():
+    before = pool_stats()['checkouts']
+    with session_scope() as db_session:
+        db_session.execute('SELECT 1')
+
+    stats = pool_stats()
+    assert stats['checkouts'] > before
+    assert stats['checked_out'] == 0
+
+
+def test_first_bump_changes_version():
+    def read(session):
+        return session.execute(
+            versions.versions_select([versions.EVENTS])).scalar()
+
+    with session_scope() as db_session:
+        db_session.execute('ALTER SEQUENCE events_version_seq RESTART')
+        assert read(db_session) == 0
+        versions.bump(db_session, versions.EVENTS)
+        assert read(db_session) == 1
+
+
+def test_compile_query_uses_numbered_params():
+    query = queries.events_select(
+        49.2, -123.1, 5000.0,
+        dt.datetime(2017, 1, 1), dt.datetime(2017, 2, 1),
+        category_id=117, limit=10)
+    sql, args = compile_query(query)
+
+    assert '$1' in sql
+    assert ':1' not in sql
+    assert 'ST_DWithin' in sql
+    assert len(args) == sql.count('$')
+    assert 117 in args
+    assert 'JOIN' not in sql
+    assert 10 in args
+    assert any('POINT(-123.1 49.2)' in str(a) for a in args)
+
+
+def test_summary_fields_skip_descriptions():
+    query = queries.events_select(
+        49.2, -123.1, 5000.0,
+        dt.datetime(2017, 1, 1), dt.datetime(2017, 2, 1),
+        sort='start_time', fields=queries.SUMMARY_FIELDS)
+    sql, _ = compile_query(query)
+
+    assert 'description_html' not in sql
+    assert 'description_text' not in sql
+    assert 'events.latitude' in sql
+
+
+def seed_events(db_session, count):
+    """Bulk load `count` events scattered around southern BC over the
+    next year, then refresh planner statistics. One in 500 titles
+    mentions jazz.
+    """
+    db_session.execute('''
+        WITH points AS (
+            SELECT g,
+                   49.2 + (random() - 0.5) * 5 AS lat,
+                   -123.1 + (random() - 0.5) * 10 AS lon
+            FROM generate_series(1, :count) AS g
+        ),
+        titled AS (
+            SELECT points.*,
+                   'Seeded event ' || g ||
+                   CASE WHEN g % 500 = 0 THEN ' jazz' ELSE '' END AS title
+            FROM points
+        )
+        INSERT INTO events (id, title, start_time, end_time, location,
+                            latitude, longitude, category_id, search_vector)
+        SELECT g,
+               title,
+               now() + (g % 365) * interval '1 day',
+               now() + (g % 365) * interval '1 day' + interval '3 hours',
+               ST_SetSRID(ST_MakePoint(lon, lat), 4326)::geography,
+               lat,
+               lon,
+               1,
+               to_tsvector('english', title)
+        FROM titled
+    ''', {'count': count})
+    db_session.commit()
+    db_session.execute('ANALYZE events')
+
+
+def explain(db_session, query):
+    """Returns the nodes of the plan Postgres picks for a Core statement."""
+    compiled = query.compile(dialect=db_session.bind.dialect)
+    processors = compiled._bind_processors
+    params = {
+        k: processors[k](v) if k in processors else v
+        for k, v in compiled.params.items()
+    }
+    cursor = db_session.connection().connection.cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), params)
+
+    nodes = []
+    pending = [cursor.fetchone()[0][0]['Plan']]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    return nodes
+
+
+@new_db()
+@add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
+def test_events_query_plan_uses_indexes():
+    with session_scope() as db_session:
+        seed_events(db_session, SEED_EVENTS)
+
+        week_start = dt.datetime.now() + dt.timedelta(days=30)
+        query = queries.events_select(
+            config.DEFAULT_LAT, config.DEFAULT_LON, 10000.0,
+            week_start, week_start + dt.timedelta(days=7))
+        nodes = explain(db_session, query)
+
+        events_scans = [
+            n for n in nodes if n.get('Relation Name') == 'events']
+        assert events_scans
+        assert all(n['Node Type'] != 'Seq Scan' for n in events_scans)
+        # Bitmap scans name the index on a child node of the heap scan.
+        assert {n.get('Index Name') for n in nodes} & {
+            'ix_events_upcoming',
+            'idx_events_location',
+            'ix_events_start_time',
+            'ix_events_end_time'
+        }
+
+
+@new_db()
+@add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
+def test_upcoming_query_plan_uses_partial_index():
+    refresh_upcoming_index()
+    with session_scope() as db_session:
+        seed_events(db_session, SEED_EVENTS)
+
+        now = dt.datetime.now()
+        query = queries.events_select(
+            config.DEFAULT_LAT, config.DEFAULT_LON, 1000000.0,
+            now, now + dt.timedelta(days=365), sort='start_time')
+        nodes = explain(db_session, query)
+
+        assert 'ix_events_upcoming' in {n.get('Index Name') for n in nodes}
+
+    # Windows reaching back before the cutoff can't use it.
+    query = queries.events_select(
+        config.DEFAULT_LAT, config.DEFAULT_LON, 1000000.0,
+        dt.datetime.min, dt.datetime.max, sort='start_time')
+    assert '::timestamp' not in str(query)
+
+
+@new_db()
+@add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
+def test_search_query_plan_uses_search_index():
+    with session_scope() as db_session:
+        seed_events(db_session, SEED_EVENTS)
+
+        query = queries.events_select(
+            config.DEFAULT_LAT, config.DEFAULT_LON, 10000.0,
+            dt.datetime.min, dt.datetime.max, sort='relevance', q='jazz')
+        nodes = explain(db_session, query)
+
+        assert 'ix_events_search_vector' in {
+            n.get('Index Name') for n in nodes}
+
+
+@new_db()
+@add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
+def test_cleanup_plan_uses_end_time_index():
+    with session_scope() as db_session:
+        seed_events(db_session, SEED_EVENTS)
+
+        stmt = Event.__table__.delete().where(
+            Event.end_time < dt.datetime.now() - dt.timedelta(days=5))
+        nodes = explain(db_session, stmt)
+
+        assert 'ix_events_end_time' in {n.get('Index Name') for n in nodes}
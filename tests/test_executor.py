@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import pytest
+
+from beluga.executor import BoundedExecutor, ExecutorSaturated
+from tests.utils import run
+
+
+def test_run_returns_result_and_records_metrics():
+    executor = BoundedExecutor('test', max_workers=2, max_queue=2)
+
+    assert run(executor.run(sum, [1, 2, 3])) == 6
+
+    stats = executor.stats()
+    assert stats['submitted'] == 1
+    assert stats['completed'] == 1
+    assert stats['queued'] == 0
+    assert stats['running'] == 0
+
+
+def test_saturated_pool_rejects_immediately():
+    executor = BoundedExecutor('test', max_workers=1, max_queue=0)
+    release = threading.Event()
+
+    async def scenario():
+        blocked = asyncio.ensure_future(executor.run(release.wait, 5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ExecutorSaturated):
+            await executor.run(sum, [1])
+        release.set()
+        await blocked
+
+    run(scenario())
+
+    stats = executor.stats()
+    assert stats['rejected'] == 1
+    assert stats['completed'] == 1
+
+
+def test_failures_are_counted_and_raised():
+    executor = BoundedExecutor('test', max_workers=1, max_queue=0)
+
+    with pytest.raises(ZeroDivisionError):
+        run(executor.run(lambda: 1 / 0))
+
+    assert executor.stats()['failed'] == 1
+    # The slot is released after a failure.
+    assert run(executor.run(sum, [2])) == 2
@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+import pytest
+
+from beluga.ratelimit import MemoryBackend
+from worker.fetch import (
+    Budget,
+    EventbriteClient,
+    FetchError,
+    TransportError,
+    get_venues,
+    run,
+    search_pages
+)
+from tests.utils import FakeEventbrite, fake_client
+
+
+class SlowTransport(FakeEventbrite):
+    """Takes a while to answer, and counts requests in flight."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get(self, url, params, headers):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return await super().get(url, params, headers)
+
+
+class FlakyTransport(FakeEventbrite):
+    """Drops the first connection."""
+
+    async def get(self, url, params, headers):
+        if not self.requests:
+            self.requests.append(('dropped', params))
+            raise TransportError('connection reset')
+        return await super().get(url, params, headers)
+
+
+def test_search_pages_in_order():
+    transport = SlowTransport(page_count=12)
+    pages = run(search_pages(fake_client(transport, concurrency=3), {}, 10))
+
+    assert [p['pagination']['page_number'] for p in pages] == list(range(1, 11))
+    assert transport.count('/events/search/') == 10
+    assert transport.max_in_flight == 3
+
+
+def test_retries_rate_limits_and_server_errors():
+    transport = FakeEventbrite(failures={'/venues/1/': [429, 503]})
+    client = fake_client(transport)
+
+    venue = run(client.get('/venues/1/'))
+    assert venue['latitude'] == '49.333'
+    assert client.calls == 3
+    assert client.retried == 2
+
+
+def test_retries_dropped_connections():
+    client = fake_client(FlakyTransport())
+    assert run(client.get('/categories/'))['categories']
+    assert client.retried == 1
+
+
+def test_gives_up_after_retries():
+    transport = FakeEventbrite(failures={'/venues/1/': [500] * 10})
+    client = fake_client(transport)
+
+    with pytest.raises(FetchError) as e:
+        run(client.get('/venues/1/'))
+    assert e.value.status == 500
+    assert client.calls == client.retries + 1
+
+
+def test_client_errors_are_not_retried():
+    client = fake_client(FakeEventbrite())
+    with pytest.raises(FetchError) as e:
+        run(client.get('/nowhere/'))
+    assert e.value.status == 404
+    assert client.calls == 1
+
+
+def test_get_venues_leaves_out_failures():
+    transport = FakeEventbrite(failures={'/venues/2/': [404]})
+    venues = run(get_venues(fake_client(transport), ['1', '2']))
+    assert list(venues) == ['1']
+
+
+def test_backoff_is_jittered_and_capped():
+    client = EventbriteClient(
+        'key', FakeEventbrite(), None, backoff=1.0, max_backoff=4.0)
+
+    delays = [client.delay(5) for _ in range(50)]
+    assert all(0 <= d <= 4.0 for d in delays)
+    assert len(set(delays)) > 1
+    assert client.delay(0, retry_after='7') >= 7
+
+
+def test_budget_waits_for_tokens():
+    budget = Budget(MemoryBackend(1), rate=20, burst=2)
+
+    async def take(n):
+        for _ in range(n):
+            await budget.take()
+
+    start = time.monotonic()
+    run(take(4))
+    assert time.monotonic() - start >= 0.09
+    assert budget.taken == 4
+    assert budget.waited > 0
@@ -0,0 +1,134 @@
+import asyncio
+import time
+
+import pytest
+from sanic.request import Request
+from sanic.response import StreamingHTTPResponse
+from sanic.server import CIDict
+
+from beluga import config
+from beluga.ratelimit import (
+    ConcurrencyLimiter, MemoryBackend, Overloaded, RateLimited,
+    TokenBucketLimiter, admission, client_ip)
+import beluga.ratelimit
+from tests.utils import run
+
+
+def test_bucket_allows_burst_then_rejects():
+    backend = MemoryBackend(max_keys=10)
+    for _ in range(3):
+        assert backend.take('a', rate=1, burst=3)[0]
+
+    allowed, retry_after = backend.take('a', rate=1, burst=3)
+    assert not allowed
+    assert 0 < retry_after <= 1
+
+    # Other keys have their own bucket.
+    assert backend.take('b', rate=1, burst=3)[0]
+
+
+def test_bucket_refills():
+    backend = MemoryBackend(max_keys=10)
+    assert backend.take('a', rate=100, burst=1)[0]
+    assert not backend.take('a', rate=100, burst=1)[0]
+    time.sleep(0.02)
+    assert backend.take('a', rate=100, burst=1)[0]
+
+
+def test_bucket_keys_are_bounded():
+    backend = MemoryBackend(max_keys=2)
+    for key in 'abc':
+        backend.take(key, rate=1, burst=1)
+    assert list(backend._buckets) == ['b', 'c']
+
+
+def test_limiter_raises_and_counts():
+    limiter = TokenBucketLimiter(MemoryBackend(10), 'user', rate=1, burst=1)
+    run(limiter.check(1))
+    with pytest.raises(RateLimited) as e:
+        run(limiter.check(1))
+    assert e.value.status_code == 429
+    assert e.value.retry_after > 0
+    assert limiter.stats()['allowed'] == 1
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_admission_sheds_load(monkeypatch):
+    limiter = ConcurrencyLimiter(MemoryBackend(10), max_in_flight=1)
+    monkeypatch.setattr(beluga.ratelimit, 'expensive', limiter)
+
+    @admission()
+    async def handler(request):
+        # A second request arriving now finds no free slot.
+        with pytest.raises(Overloaded):
+            await admission()(lambda request: None)(request)
+        return 'ok'
+
+    assert run(handler(None)) == 'ok'
+    assert limiter.stats()['in_flight'] == 0
+    assert limiter.stats()['rejected'] == 1
+
+
+def test_admission_slots_shared_through_backend():
+    # Two workers' limiters over one backend, as with Redis.
+    backend = MemoryBackend(10)
+    first = ConcurrencyLimiter(backend, max_in_flight=2)
+    second = ConcurrencyLimiter(backend, max_in_flight=2)
+
+    lease = run(first.acquire())
+    run(second.acquire())
+    with pytest.raises(Overloaded):
+        run(second.acquire())
+
+    first.release(lease)
+    run(second.acquire())
+    assert second.stats()['in_flight'] == 2
+
+
+def test_admission_leases_expire():
+    limiter = ConcurrencyLimiter(MemoryBackend(10), 1, lease_ttl=0.01)
+    run(limiter.acquire())
+    time.sleep(0.02)
+    # The first holder never released, as if its worker had died.
+    run(limiter.acquire())
+
+
+class Peer:
+    def get_extra_info(self, name):
+        return ('10.0.0.1', 4321) if name == 'peername' else None
+
+
+def request_from(forwarded_for):
+    headers = CIDict()
+    if forwarded_for:
+        headers['X-Forwarded-For'] = forwarded_for
+    return Request(b'/events', headers, '1.1', 'GET', Peer())
+
+
+def test_client_ip_ignores_spoofed_hops(monkeypatch):
+    monkeypatch.setattr(config, 'RATE_LIMIT_TRUSTED_PROXIES', 1)
+    # The client claims to be 1.2.3.4; the router appends its real address.
+    assert client_ip(request_from('1.2.3.4, 203.0.113.9')) == '203.0.113.9'
+    assert client_ip(request_from('203.0.113.9')) == '203.0.113.9'
+    assert client_ip(request_from(None)) == '10.0.0.1'
+
+    monkeypatch.setattr(config, 'RATE_LIMIT_TRUSTED_PROXIES', 2)
+    assert client_ip(request_from(
+        '1.2.3.4, 203.0.113.9, 10.1.1.1')) == '203.0.113.9'
+
+    monkeypatch.setattr(config, 'RATE_LIMIT_TRUSTED_PROXIES', 0)
+    assert client_ip(request_from('1.2.3.4')) == '10.0.0.1'
+
+
+def test_admission_released_when_stream_never_starts(monkeypatch):
+    limiter = ConcurrencyLimiter(MemoryBackend(10), max_in_flight=1)
+    monkeypatch.setattr(beluga.ratelimit, 'expensive', limiter)
+
+    @admission()
+    async def handler(request):
+        return StreamingHTTPResponse(None)
+
+    response = run(handler(None))
+    run(asyncio.sleep(0))
+    assert response.streaming_fn is not None
+    assert limiter.stats()['in_flight'] == 0
@@ -1,6 +1,15 @@
+import asyncio
+import datetime as dt
+import socket
+from urllib.parse import urlparse
+
 import ujson as json
 
-from beluga import app
+from beluga import app, ratelimit, versions
+from beluga import config as conf
+from beluga.cache import events_cache
+from beluga.models import EventAttendee, session_scope
+from beluga.routes import FlowControl, decode_cursor, encode_cursor
 from tests.utils import (
     mock_events,
     add_db_categories,
@@ -110,7 +119,7 @@ def test_good_limit():
         'Authorization': 'Bearer GOOD_TEST_TOKEN'
     })
     assert response.status == 200
-    assert len(response.json) == 1
+    assert len(response.json['results']) == 1
 
 
 @new_db()
@@ -196,3 +205,411 @@ def test_retreive_rsvp():
             assert len(e['attendees']) == 0
 
 
+
+
+def test_metrics_reports_db_pool():
+    _, response = app.test_client.get('/metrics', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 200
+    assert 'checkouts' in response.json['db_pool']
+
+
+def test_bad_attendees_limit():
+    _, response = app.test_client.get("/events?attendees_limit=lots", headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 400
+
+
+@new_db()
+@mock_events()
+@mock_users()
+def test_attendees_limit_keeps_count():
+    route = '/events/27489090610/rsvp'
+    _, response = app.test_client.post(route, headers={
+        'Authorization': 'Bearer {}'.format(magic_bearer_token)
+    })
+    assert response.status == 204
+
+    _, response = app.test_client.get('/events?attendees_limit=0', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 200
+
+    for e in response.json['results']:
+        assert e['attendees'] == []
+        if e['id'] == 27489090610:
+            assert e['attendee_count'] == 1
+        else:
+            assert e['attendee_count'] == 0
+
+
+@new_db()
+@mock_events()
+@mock_users()
+def test_rsvp_writes_attendee_rows():
+    route = '/events/27489090610/rsvp'
+    headers = {'Authorization': 'Bearer {}'.format(magic_bearer_token)}
+
+    for _ in range(2):
+        _, response = app.test_client.post(route, headers=headers)
+        assert response.status == 204
+
+    with session_scope() as db_session:
+        rows = db_session.query(EventAttendee).all()
+        assert [(r.event_id, r.user_id) for r in rows] == [(27489090610, 1)]
+
+    _, response = app.test_client.delete(route, headers=headers)
+    assert response.status == 204
+
+    with session_scope() as db_session:
+        assert db_session.query(EventAttendee).count() == 0
+
+
+@new_db()
+@mock_users()
+def test_rsvp_unknown_event():
+    headers = {'Authorization': 'Bearer {}'.format(magic_bearer_token)}
+    for method in (app.test_client.post, app.test_client.delete):
+        _, response = method('/events/1234/rsvp', headers=headers)
+        assert response.status == 404
+
+
+def relative(url):
+    """Strips scheme and host so the test client can follow a URL."""
+    if url is None:
+        return None
+    parts = urlparse(url)
+    return '{}?{}'.format(parts.path, parts.query)
+
+
+@new_db()
+@mock_events()
+def test_cursor_pagination_walks_all_events():
+    headers = {'Authorization': 'Bearer GOOD_TEST_TOKEN'}
+    for sort in ('distance', 'start_time'):
+        _, response = app.test_client.get(
+            '/events?limit=100&sort={}'.format(sort), headers=headers)
+        everything = [e['id'] for e in response.json['results']]
+        assert response.json['next'] is None
+        assert response.json['previous'] is None
+
+        seen = []
+        pages = []
+        url = '/events?limit=2&sort={}'.format(sort)
+        while url:
+            _, response = app.test_client.get(url, headers=headers)
+            assert response.status == 200
+            pages.append(response.json)
+            seen += [e['id'] for e in response.json['results']]
+            url = relative(response.json['next'])
+
+        assert seen == everything
+        assert pages[0]['previous'] is None
+
+        # Stepping back from the second page returns the first.
+        if len(pages) > 1:
+            _, response = app.test_client.get(
+                relative(pages[1]['previous']), headers=headers)
+            assert response.json['results'] == pages[0]['results']
+
+
+def test_bad_cursor():
+    headers = {'Authorization': 'Bearer GOOD_TEST_TOKEN'}
+    _, response = app.test_client.get('/events?cursor=forged', headers=headers)
+    assert response.status == 400
+
+    _, response = app.test_client.get('/events?sort=title', headers=headers)
+    assert response.status == 400
+
+
+def test_cursor_round_trip():
+    row = {
+        'id': 7,
+        'distance': 1234.5678901234567,
+        'start_time': dt.datetime(2017, 11, 3, 18, 30, 0, 12)
+    }
+    for sort in ('distance', 'start_time'):
+        token = encode_cursor(row, sort, True)
+        cursor = decode_cursor(token, sort)
+        assert cursor.value == row[sort]
+        assert cursor.id == 7
+        assert cursor.backwards
+
+
+@new_db()
+@mock_events()
+@mock_users()
+def test_events_cache_serves_repeats_and_sees_rsvps():
+    headers = {'Authorization': 'Bearer {}'.format(magic_bearer_token)}
+    hits = events_cache.stats()['hits']
+
+    _, first = app.test_client.get('/events', headers=headers)
+    _, second = app.test_client.get('/events', headers=headers)
+    assert second.json == first.json
+    assert events_cache.stats()['hits'] == hits + 1
+
+    # An RSVP expires the cached page it appears on.
+    _, response = app.test_client.post(
+        '/events/27489090610/rsvp', headers=headers)
+    assert response.status == 204
+
+    _, third = app.test_client.get('/events', headers=headers)
+    counts = {e['id']: e['attendee_count'] for e in third.json['results']}
+    assert counts[27489090610] == 1
+
+
+@new_db()
+@mock_events()
+def test_event_location_from_columns():
+    _, response = app.test_client.get('/events', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 200
+    for e in response.json['results']:
+        assert e['location'] == {
+            'lat': conf.DEFAULT_LAT,
+            'lon': conf.DEFAULT_LON
+        }
+
+
+@new_db()
+@mock_events()
+@mock_users()
+def test_streamed_events_match_buffered():
+    headers = {'Authorization': 'Bearer {}'.format(magic_bearer_token)}
+    _, buffered = app.test_client.get(
+        '/events?limit=2&sort=start_time', headers=headers)
+    _, streamed = app.test_client.get(
+        '/events?limit=2&sort=start_time&stream=true', headers=headers)
+    assert streamed.status == 200
+    assert streamed.headers['Transfer-Encoding'] == 'chunked'
+    assert streamed.json['results'] == buffered.json['results']
+    assert relative(streamed.json['next']) == \
+        relative(buffered.json['next']).replace('&stream=true', '')
+
+
+@new_db()
+@mock_events()
+def test_summary_fields():
+    _, response = app.test_client.get('/events?fields=summary', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 200
+    assert response.json['results']
+    for e in response.json['results']:
+        assert set(e) == {'id', 'title', 'location', 'start_time'}
+
+    _, response = app.test_client.get(
+        '/events?fields=summary,attendee_count', headers={
+            'Authorization': 'Bearer GOOD_TEST_TOKEN'
+        })
+    for e in response.json['results']:
+        assert e['attendee_count'] == 0
+        assert 'description_html' not in e
+
+
+def test_unknown_field():
+    _, response = app.test_client.get('/events?fields=title,secrets', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 400
+
+
+@new_db()
+@mock_events()
+def test_search_events():
+    _, response = app.test_client.get('/events?q=devops', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 200
+    assert [e['id'] for e in response.json['results']] == [27489090610]
+
+    # Search combines with the other filters.
+    _, response = app.test_client.get(
+        '/events?q=devops&category=new_cat2', headers={
+            'Authorization': 'Bearer GOOD_TEST_TOKEN'
+        })
+    assert response.json['results'] == []
+
+
+def test_relevance_needs_query():
+    _, response = app.test_client.get('/events?sort=relevance', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 400
+
+
+@new_db()
+@mock_events()
+def test_batch_events():
+    _, response = app.test_client.post(
+        '/events/batch',
+        data=json.dumps({
+            'queries': [
+                {'lat': 49, 'lon': -123, 'radius': 50},
+                {'lat': -49, 'lon': 123, 'radius': 50},
+                {'category': 'new_cat1', 'limit': 5}
+            ],
+            'fields': 'summary,category'
+        }),
+        headers={'Authorization': 'Bearer GOOD_TEST_TOKEN'})
+    assert response.status == 200
+
+    near, far, music = response.json['results']
+    assert len(near['results']) > 0
+    assert far['results'] == []
+    assert [e['category'] for e in music['results']] == ['new_cat1']
+
+    # Each result set matches the equivalent GET.
+    _, single = app.test_client.get(
+        '/events?lat=49&lon=-123&radius=50&fields=summary,category',
+        headers={'Authorization': 'Bearer GOOD_TEST_TOKEN'})
+    assert near['results'] == single.json['results']
+
+
+def test_batch_events_bounds():
+    for body in ({}, {'queries': []}, {'queries': [{}] * 21},
+                 {'queries': [{'lat': 'north'}]}):
+        _, response = app.test_client.post(
+            '/events/batch', data=json.dumps(body),
+            headers={'Authorization': 'Bearer GOOD_TEST_TOKEN'})
+        assert response.status == 400
+
+
+@new_db()
+@mock_events()
+@mock_users()
+def test_events_etag():
+    headers = {'Authorization': 'Bearer {}'.format(magic_bearer_token)}
+    _, response = app.test_client.get('/events', headers=headers)
+    assert response.status == 200
+    etag = response.headers['ETag']
+
+    _, response = app.test_client.get('/events', headers=dict(
+        headers, **{'If-None-Match': etag}))
+    assert response.status == 304
+    assert response.text == ''
+
+    # An RSVP changes the attendee lists, and so the version.
+    _, response = app.test_client.post(
+        '/events/27489090610/rsvp', headers=headers)
+    assert response.status == 204
+
+    _, response = app.test_client.get('/events', headers=dict(
+        headers, **{'If-None-Match': etag}))
+    assert response.status == 200
+    assert response.headers['ETag'] != etag
+
+
+@new_db()
+@mock_events()
+@mock_users()
+def test_events_cache_outlives_version_bump():
+    headers = {'Authorization': 'Bearer {}'.format(magic_bearer_token)}
+    _, response = app.test_client.get('/events', headers=headers)
+    etag = response.headers['ETag']
+    hits = events_cache.stats()['hits']
+
+    # A change elsewhere moves the version, and so the tag, but leaves
+    # this area's cached body alone.
+    with session_scope() as session:
+        versions.bump(session, versions.EVENTS)
+
+    _, response = app.test_client.get('/events', headers=headers)
+    assert response.headers['ETag'] != etag
+    assert events_cache.stats()['hits'] == hits + 1
+
+
+@new_db()
+@add_db_categories([{'category_id': 117, 'name': 'new_cat1'}])
+def test_categories_etag():
+    _, response = app.test_client.get('/categories')
+    etag = response.headers['ETag']
+
+    _, response = app.test_client.get(
+        '/categories', headers={'If-None-Match': 'W/"x", ' + etag})
+    assert response.status == 304
+
+
+@new_db()
+@mock_events()
+def test_unknown_category_filter():
+    _, response = app.test_client.get('/events?category=no_such_cat', headers={
+        'Authorization': 'Bearer GOOD_TEST_TOKEN'
+    })
+    assert response.status == 200
+    assert response.json['results'] == []
+
+
+@new_db()
+@add_db_categories([{'category_id': 117, 'name': 'new_cat1'}])
+def test_category_catalog_follows_version():
+    _, response = app.test_client.get('/categories')
+    assert response.json['results'] == ['new_cat1']
+
+    # add_db_categories bumps the categories version, as the worker does.
+    add_db_categories([{'category_id': 118, 'name': 'new_cat2'}])(
+        lambda: None)()
+    _, response = app.test_client.get('/categories')
+    assert sorted(response.json['results']) == ['new_cat1', 'new_cat2']
+
+
+def test_ip_rate_limit(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'ip_limiter', ratelimit.TokenBucketLimiter(
+        ratelimit.MemoryBackend(10), 'ip', rate=0.01, burst=1))
+    headers = {'Authorization': 'Bearer BAD_TEST_TOKEN'}
+
+    _, response = app.test_client.get('/events', headers=headers)
+    assert response.status == 403
+    _, response = app.test_client.get('/events', headers=headers)
+    assert response.status == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+    # Health checks are never limited.
+    _, response = app.test_client.get('/')
+    assert response.status == 200
+
+
+def test_stream_waits_for_slow_client():
+    loop = asyncio.get_event_loop()
+    size = 2 ** 20
+
+    async def scenario():
+        connected = loop.create_future()
+        server = await loop.create_server(
+            lambda: ConnectedProtocol(connected), '127.0.0.1', 0)
+        client = socket.socket()
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.setblocking(False)
+        await loop.sock_connect(client, server.sockets[0].getsockname())
+        transport = await connected
+        transport.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        flow = FlowControl(transport, high=2 ** 10)
+        try:
+            transport.write(b'x' * size)
+            drain = asyncio.ensure_future(flow.drain())
+            await asyncio.sleep(0.05)
+            assert not drain.done()
+
+            received = 0
+            while received < size:
+                received += len(await loop.sock_recv(client, 2 ** 16))
+            await asyncio.wait_for(drain, 1)
+        finally:
+            flow.release()
+            client.close()
+            server.close()
+        assert transport.get_protocol() is flow.protocol
+
+    loop.run_until_complete(scenario())
+
+
+class ConnectedProtocol(asyncio.Protocol):
+    def __init__(self, connected):
+        self.connected = connected
+
+    def connection_made(self, transport):
+        self.connected.set_result(transport)
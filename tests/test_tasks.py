@@ -6,43 +6,13 @@ from unittest.mock import patch
 from freezegun import freeze_time
 from geoalchemy2 import WKTElement
 
-from beluga.models import Event, Category, session_scope
+from beluga.models import (
+    Event, EventAttendee, Category, User, Venue, session_scope
+)
 from beluga.util import wkt_to_location
 import worker as tasks
 from tests import FIXTURES_DIR
-from tests.utils import new_db, add_db_categories
-
-
-class MockEventbrite:
-
-    def __init__(self, token):
-        pass
-
-    def event_search(self, **data):
-        with open(os.path.join(
-            FIXTURES_DIR, 'events.json')
-        ) as infile:
-            return {
-                "pagination": {
-                    "page_size": 50,
-                    "page_count": 29
-                }, "events": json.load(infile)
-            }
-
-    def get_categories(self):
-        return {
-            'categories': [{
-                'id': 1,
-                'name': 'new_category'
-            }]
-        }
-
-    @classmethod
-    def get(self, *args):
-        return {
-            'latitude': "49.333",
-            'longitude': "-123.1512"
-        }
+from tests.utils import new_db, add_db_categories, fake_eventbrite
 
 
 def new_event_dict():
@@ -52,15 +22,91 @@ def new_event_dict():
         start_time=dt.datetime(2016, 5, 5, 1, 2),
         end_time=dt.datetime(2016, 5, 5, 1, 7),
         location=WKTElement('POINT(1 2)', srid=4326),
+        latitude=2.0,
+        longitude=1.0,
         category_id=1
     )
 
 
-@patch('worker.Eventbrite', new=MockEventbrite)
-@patch('worker.load_event')
-def test_fetch_events(mock_load_event):
+def eager(f):
+    """Runs tasks fanned out by the test in the calling process."""
+    def wrapped_f(*args):
+        tasks.celery.conf.task_always_eager = True
+        try:
+            f(*args)
+        finally:
+            tasks.celery.conf.task_always_eager = False
+    return wrapped_f
+
+
+@eager
+@fake_eventbrite()
+@patch('worker.load_events')
+def test_fetch_events(eventbrite, mock_load_events):
+    mock_load_events.return_value = {}
+    summary = tasks.fetch_events(lat=1, lon=2, rad=3)
+    assert summary == {'page_count': 29, 'pages': 29}
+
+    # The first page also gives the page count.
+    assert eventbrite.count('/events/search/') == 29
+
+    # One batch per page.
+    assert mock_load_events.call_count == 29
+    loaded = sum(len(c[0][0]) for c in mock_load_events.call_args_list)
+    assert loaded == 145
+
+
+@eager
+@new_db()
+@fake_eventbrite()
+@patch('worker.load_events')
+def test_fetch_events_looks_up_venues_once(eventbrite, mock_load_events):
+    mock_load_events.return_value = {}
     tasks.fetch_events(lat=1, lon=2, rad=3)
-    assert mock_load_event.call_count == 145
+
+    # Every page has the same single venue, kept in the venues table.
+    assert eventbrite.count('/venues/') == 1
+    with session_scope() as db_session:
+        assert db_session.query(Venue).one().latitude == 49.333
+
+
+@eager
+@fake_eventbrite(failures={'/events/search/': [503] * 10})
+def test_failed_page_is_reported(eventbrite):
+    with patch.object(tasks.fetch_page, 'max_retries', 0):
+        result = tasks.fetch_page.apply(args=({}, 2)).get()
+
+    assert result == {'page': 2, 'failed': 1}
+    assert eventbrite.count('/events/search/') == 5
+
+
+def test_summarize_pages():
+    summary = tasks.summarize_pages([
+        {'page': 2, 'inserted': 1, 'updated': 2, 'unchanged': 3},
+        {'page': 3, 'failed': 1}
+    ], {'page': 1, 'inserted': 4, 'updated': 0, 'unchanged': 0})
+
+    assert summary == {
+        'pages': 3, 'failed': 1, 'inserted': 5, 'updated': 2, 'unchanged': 3
+    }
+
+
+@new_db()
+@fake_eventbrite()
+@patch('worker.refresh_venues')
+def test_stale_venues_used_while_refreshing(eventbrite, mock_refresh_venues):
+    expired = dt.timedelta(seconds=tasks.config.VENUE_TTL, days=1)
+    with session_scope() as db_session:
+        db_session.add(Venue(
+            id='1', latitude=49.0, longitude=-123.0,
+            fetched_at=dt.datetime.now() - expired))
+        db_session.commit()
+
+        venues = tasks.get_venues(['1', '1', None], db_session)
+
+    assert venues == {'1': {'latitude': 49.0, 'longitude': -123.0}}
+    assert eventbrite.count('/venues/') == 0
+    mock_refresh_venues.delay.assert_called_once_with(['1'])
 
 
 @new_db()
@@ -84,6 +130,62 @@ def test_load_event():
         assert loc.x == lat
         assert loc.y == lon
 
+        # Plain coordinate columns match the geography.
+        assert result.latitude == loc.y
+        assert result.longitude == loc.x
+
+
+def test_content_hash_is_stable():
+    with open(os.path.join(FIXTURES_DIR, 'events.json')) as infile:
+        event = json.load(infile)[0]
+    venue = {'latitude': '49.333', 'longitude': '-123.1512'}
+
+    first = tasks.prepare_event(event, venue)
+    again = tasks.prepare_event(event, venue)
+    assert again['content_hash'] == first['content_hash']
+
+    event['name']['text'] = 'Something else entirely'
+    changed = tasks.prepare_event(event, venue)
+    assert changed['content_hash'] != first['content_hash']
+
+
+@new_db()
+@add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
+@patch('worker.config.EVENT_BATCH_SIZE', new=2)
+def test_load_events_counts_changes():
+    events = []
+    for i in range(1, 4):
+        event = new_event_dict()
+        event['id'] = i
+        events.append(event)
+
+    with session_scope() as db_session:
+        counts = tasks.load_events(events, db_session)
+        assert counts == {'inserted': 3, 'updated': 0, 'unchanged': 0}
+
+        # Same data again, except one new title.
+        events[1] = dict(events[1], title='Even more good stuff')
+        counts = tasks.load_events(events, db_session)
+        assert counts == {'inserted': 0, 'updated': 1, 'unchanged': 2}
+
+        assert db_session.query(Event).get(2).title == 'Even more good stuff'
+
+
+@new_db()
+@add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
+@patch('worker.events_cache')
+def test_load_events_invalidates_old_position(mock_cache):
+    event = new_event_dict()
+    moved = dict(event, location=WKTElement('POINT(50 40)', srid=4326),
+                 latitude=40.0, longitude=50.0)
+
+    with session_scope() as db_session:
+        tasks.load_events([event], db_session)
+        tasks.load_events([moved], db_session)
+
+    points = mock_cache.invalidate.call_args[0][0]
+    assert set(points) == {(2.0, 1.0), (40.0, 50.0)}
+
 
 @new_db()
 @add_db_categories([{'category_id': 1, 'name': 'new_cat'}])
@@ -93,10 +195,14 @@ def test_events_dont_get_clobbered():
     """
     # Mock up event with attendees, insert to db.
     event_with_attendees = new_event_dict()
-    event_with_attendees['attendees'] = ['alice', 'bob']
 
     with session_scope() as db_session:
         db_session.add(Event(**event_with_attendees))
+        db_session.add(User(id=1, given_name='alice'))
+        db_session.add(User(id=2, given_name='bob'))
+        db_session.flush()
+        db_session.add(EventAttendee(event_id=1, user_id=1))
+        db_session.add(EventAttendee(event_id=1, user_id=2))
         db_session.commit()
 
         # Try to inject a vanilla event without attendees.
@@ -107,7 +213,7 @@ def test_events_dont_get_clobbered():
         this_id = the_same_event['id']
         result = db_session.query(Event).filter(Event.id == this_id).all()
         assert len(result) == 1
-        assert result[0].attendees == event_with_attendees['attendees']
+        assert db_session.query(EventAttendee).count() == 2
         assert result[0].title == event_with_attendees['title']
 
     # Change the event title, reload db, test the upsert took place.
@@ -117,7 +223,7 @@ def test_events_dont_get_clobbered():
         tasks.load_event(the_same_event, db_session)
         result = db_session.query(Event).filter(Event.id == this_id).all()
         assert len(result) == 1
-        assert result[0].attendees == event_with_attendees['attendees']
+        assert db_session.query(EventAttendee).count() == 2
         assert result[0].title == new_title
 
 
@@ -140,8 +246,8 @@ def test_events_cleanup_daily():
 
 
 @new_db()
-@patch('worker.Eventbrite', new=MockEventbrite)
-def test_update_categories():
+@fake_eventbrite()
+def test_update_categories(eventbrite):
     tasks.update_categories(force=True)
     with session_scope() as db_session:
         db_session.query(Category).count() == 1
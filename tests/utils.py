@@ -1,16 +1,62 @@
+import asyncio
 import json
+import time
+from unittest.mock import patch
+from urllib.parse import urlparse
 
+from google.auth import crypt, jwt
 import sqlalchemy.dialects.postgresql as psql
 
-from beluga import config as conf
+from beluga import auth, config as conf, versions
+from beluga.ratelimit import MemoryBackend
+from beluga.cache import events_cache
+from beluga.revocation import revocations
 from beluga.models import (
-    Base, session_scope, Category, Event, User
+    Base, session_scope, Category, User
 )
-from worker import prepare_event
+from worker import load_event, prepare_event
+from worker.fetch import Budget, EventbriteClient
 
 # UID 1, signed with secret base in dockerfile
 magic_bearer_token = str('eyJ0eXBlIjogImJlYXJlciIsICJ2YWwiOiAxfS5kYUhSY2F4eXYtUTNkNmpZM2tmNXRfdEl1NEk=')
 
+def run(coro):
+    """Runs a coroutine to completion on the default loop."""
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+# A key pair standing in for Google's, under key id 'k1'.
+with open('tests/fixtures/google_key.pem') as f:
+    GOOGLE_KEY = f.read()
+with open('tests/fixtures/google_cert.pem') as f:
+    GOOGLE_CERT = f.read()
+
+
+def google_token(**claims):
+    """A Google ID token signed with the fixture key, for GOOGLE_CERT."""
+    now = int(time.time())
+    payload = {
+        'iss': 'https://accounts.google.com',
+        'aud': conf.GOOGLE_CLIENT_ID,
+        'sub': '1234',
+        'iat': now,
+        'exp': now + 600
+    }
+    payload.update(claims)
+    signer = crypt.RSASigner.from_string(GOOGLE_KEY)
+    return jwt.encode(signer, payload, key_id='k1').decode('ascii')
+
+
+def clear_cache():
+    """Drops cached responses and users, which would hide direct DB
+    changes.
+    """
+    if events_cache is not None:
+        events_cache.clear()
+    auth.token_cache.clear()
+    revocations.clear()
+
+
 class new_db:
     """A decorator for clearing the database before and
     after a function call (presumably a test).
@@ -22,6 +68,8 @@ class new_db:
             for table in reversed(meta.sorted_tables):
                 session.execute(table.delete())
             session.commit()
+            versions.bump(session, versions.EVENTS, versions.CATEGORIES)
+        clear_cache()
 
     def __call__(self, f):
         """Executes the wrapped version of the function.
@@ -51,6 +99,8 @@ class add_db_categories:
                             index_elements=[Category.category_id],
                             set_=i))
                 session.execute(stmt)
+            session.commit()
+            versions.bump(session, versions.CATEGORIES)
 
     def __call__(self, f):
         def wrapped_f(*args):
@@ -88,16 +138,12 @@ class mock_events:
             # Add events, if they're already there from calling this
             # decorator earlier, do update.
             for e in events:
-                prepped = prepare_event(e, venue)
-                q = (psql.insert(Event).values(**prepped)
-                         .on_conflict_do_update(
-                             index_elements=[Event.id],
-                             set_=prepped))
-                session.execute(q)
+                load_event(prepare_event(e, venue), session)
 
     def __call__(self, f):
         def wrapped_f(*args):
             self.add_events()
+            clear_cache()
             f(*args)
         return wrapped_f
 
@@ -126,3 +172,75 @@ class mock_users:
             self.add_users()
             f(*args)
         return wrapped_f
+
+
+class FakeEventbrite:
+    """A transport for `worker.fetch.EventbriteClient` answering like
+    Eventbrite, from the event fixtures.
+
+    Args:
+        page_count (int): Pages of search results to report.
+        failures (dict): Statuses to answer a path with, in order,
+            before answering it properly.
+    """
+
+    def __init__(self, page_count=29, failures=None):
+        self.page_count = page_count
+        self.failures = failures or {}
+        self.requests = []
+        with open('tests/fixtures/events.json') as infile:
+            self.events = json.load(infile)
+
+    async def get(self, url, params, headers):
+        path = urlparse(url).path.split('/v3', 1)[-1]
+        self.requests.append((path, params))
+
+        if self.failures.get(path):
+            return self.failures[path].pop(0), {}, None
+        if path == '/events/search/':
+            return 200, {}, {
+                'pagination': {
+                    'page_number': int(params['page']),
+                    'page_size': 50,
+                    'page_count': self.page_count
+                },
+                'events': self.events
+            }
+        if path.startswith('/venues/'):
+            return 200, {}, {'latitude': '49.333', 'longitude': '-123.1512'}
+        if path == '/categories/':
+            return 200, {}, {'categories': [{'id': 1, 'name': 'new_category'}]}
+        return 404, {}, None
+
+    def count(self, prefix):
+        """Requests made for paths starting with `prefix`."""
+        return sum(1 for path, _ in self.requests if path.startswith(prefix))
+
+    async def close(self):
+        pass
+
+
+def fake_client(transport, concurrency=8):
+    """An Eventbrite client over `transport` without waits between
+    calls or retries.
+    """
+    return EventbriteClient(
+        'NOT_A_KEY', transport, Budget(MemoryBackend(1), 1000, 1000),
+        concurrency=concurrency, backoff=0)
+
+
+class fake_eventbrite:
+    """A decorator passing a FakeEventbrite to the test, which every
+    client made with `worker.fetch.connect` uses meanwhile.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def __call__(self, f):
+        def wrapped_f(*args):
+            transport = FakeEventbrite(**self.kwargs)
+            with patch('worker.fetch.connect',
+                       new=lambda: fake_client(transport)):
+                f(*args, transport)
+        return wrapped_f
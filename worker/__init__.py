@@ -1,15 +1,23 @@
 import datetime as dt
+import hashlib
+import json
 import logging
+import random
 
-from celery import Celery
+from celery import Celery, chord
 from celery.schedules import crontab
-from eventbrite import Eventbrite
 from geoalchemy2 import WKTElement
+import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql as psql
 
-from beluga.models import Event, Category, session_scope
+from beluga import versions
+from beluga.cache import events_cache
+from beluga.models import (
+    Event, Category, Venue, refresh_upcoming_index, search_document,
+    session_scope
+)
 import beluga.config
-from worker import config
+from worker import config, fetch
 
 
 # Create a celery worker.
@@ -54,12 +62,20 @@ def fetch_events(self, lat, lon, rad, **params):
     """Fetches events for a circle around the given coordinate
     of radius `rad'.
 
+    The first page of results is loaded here. Every other page is
+    fetched and loaded by its own `fetch_page` task, so collection
+    spreads over the available workers, and `summarize_pages` reports
+    the totals once they are all done.
+
     Args:
         lat (str): A latitude for the centroid coordinate.
         lon (str): A longitude for the centroid coordinate.
         rad (str): A radius for the circle.
         **params : Additional paramters to be passed to the
             eventbrite client.
+
+    Returns:
+        A dict with the number of pages found and being collected.
     """
     assert config.EVENTBRITE_APP_KEY, \
         'Must set EVENTBRITE_APP_KEY to run eventbrite tasks'
@@ -69,7 +85,6 @@ def fetch_events(self, lat, lon, rad, **params):
     update_categories(force=False)
 
     logger.info("Starting event collection.")
-    eb = Eventbrite(config.EVENTBRITE_APP_KEY)
 
     # Build request.
     data = {
@@ -82,35 +97,175 @@ def fetch_events(self, lat, lon, rad, **params):
     data.update(params)
 
     # Find out how many pages to collect.
-    pagination = eb.event_search(**data)['pagination']
-    num_pages = pagination['page_count']
+    first = fetch.call(fetch.search_page, data, 1)
+    num_pages = first['pagination']['page_count']
     to_collect = min(num_pages, config.EVENTBRITE_EVENT_PAGES)
+    logger.info('Collecting {} of {} pages'.format(to_collect, num_pages))
+
+    first_counts = dict(load_page(first['events']), page=1)
+    if to_collect > 1:
+        chord(
+            fetch_page.s(data, page) for page in range(2, to_collect + 1)
+        )(summarize_pages.s(first_counts))
+    else:
+        summarize_pages([], first_counts)
+
+    return {'page_count': num_pages, 'pages': to_collect}
+
+
+@celery.task(bind=True, acks_late=True, max_retries=config.PAGE_RETRIES)
+def fetch_page(self, data, page):
+    """Fetches and loads one page of an event search.
+
+    Loading upserts by event id, so a page can be retried, or
+    redelivered after a worker dies, without harm. A page that still
+    fails after PAGE_RETRIES is reported rather than raised, so the
+    other pages are still summarized.
+
+    Returns:
+        The page's load counts, as from `load_events`.
+    """
+    try:
+        result = fetch.call(fetch.search_page, data, page)
+        return dict(load_page(result['events']), page=page)
+    except (fetch.FetchError, sa.exc.OperationalError) as e:
+        if self.request.retries < self.max_retries:
+            countdown = random.uniform(
+                0, config.PAGE_RETRY_BACKOFF * 2 ** self.request.retries)
+            raise self.retry(exc=e, countdown=countdown)
+        logger.error('Giving up on page {}: {}'.format(page, e))
+        return {'page': page, 'failed': 1}
+
+
+@celery.task()
+def summarize_pages(results, first):
+    """Totals the counts of every page of a collection.
+
+    Args:
+        results (list): The results of the `fetch_page` tasks.
+        first (dict): The counts of the first page.
+    """
+    summary = {
+        'pages': 0, 'failed': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0
+    }
+    for counts in [first] + list(results):
+        summary['pages'] += 1
+        for key in ('failed', 'inserted', 'updated', 'unchanged'):
+            summary[key] += counts.get(key, 0)
+
+    logger.info(
+        'Loaded {pages} pages ({failed} failed): {inserted} inserted, '
+        '{updated} updated, {unchanged} unchanged.'.format(**summary))
+    return summary
 
-    # Produce a new task to load every event.
+
+def load_page(events):
+    """Loads one page of search results, looking up its venues.
+
+    Returns:
+        The counts from `load_events`.
+    """
     with session_scope() as db_session:
+        # Venues repeat across events, look each up once.
+        venues = get_venues([e['venue_id'] for e in events], db_session)
+
+        new_events = []
+        for event in events:
+            if event['venue_id'] is None:
+                venue = NO_VENUE
+            elif event['venue_id'] in venues:
+                venue = venues[event['venue_id']]
+            else:
+                continue
+            new_events.append(prepare_event(event, venue))
+
+        return load_events(new_events, db_session)
+
+
+# Events without a venue are online; Eventbrite places online venues
+# at (0, 0), which `is_online` recognizes.
+NO_VENUE = {'latitude': '0', 'longitude': '0'}
+
+
+def get_venues(venue_ids, session):
+    """Looks up venues through the venues table.
 
-        # Collect several pages.
-        logger.info('Collecting {} pages'.format(num_pages))
-        for page in range(1, to_collect+1):
+    Venues fetched within VENUE_TTL are used as they are. Older ones,
+    up to VENUE_STALE_TTL more, are used too and refreshed by a
+    separate task. The rest are fetched from Eventbrite now.
 
-            # Collect this page.
-            data.update({'page': page})
-            result = eb.event_search(**data)
-            logger.info(
-                'Processing {} of {} pages: loading {} events...'.format(
-                    page,
-                    to_collect,
-                    result['pagination']['page_size']
-                )
-            )
+    Args:
+        venue_ids (iterable): Venue ids, possibly repeated or None.
+        session (sa.scoped_session): A SQLAlchemy session.
 
-            # Get venue for each event and load.
-            for event in result['events']:
-                venue = eb.get('/venues/{}'.format(event['venue_id']))
-                new_event = prepare_event(event, venue)
-                load_event(new_event, db_session)
+    Returns:
+        A dict of venue id to venue, for the venues that were found.
+    """
+    ids = {i for i in venue_ids if i is not None}
+    if not ids:
+        return {}
+
+    age = sa.func.extract('epoch', sa.func.now() - Venue.fetched_at)
+    rows = (session.query(Venue, age)
+                   .filter(Venue.id.in_(ids))
+                   .all())
+
+    venues = {}
+    stale = []
+    for venue, seconds in rows:
+        if seconds >= config.VENUE_TTL + config.VENUE_STALE_TTL:
+            continue
+        if seconds >= config.VENUE_TTL:
+            stale.append(venue.id)
+        venues[venue.id] = {
+            'latitude': venue.latitude,
+            'longitude': venue.longitude
+        }
+
+    venues.update(fetch_venues(ids - venues.keys(), session))
+
+    if stale:
+        refresh_venues.delay(stale)
+
+    return venues
+
+
+def fetch_venues(venue_ids, session):
+    """Fetches venues from Eventbrite and stores them in the venues
+    table. Returns a dict of venue id to venue.
+    """
+    if not venue_ids:
+        return {}
+
+    venues = {}
+    for venue_id, venue in fetch.call(fetch.get_venues, venue_ids).items():
+        if venue.get('latitude') is None or venue.get('longitude') is None:
+            logger.warning('No location for venue {}'.format(venue_id))
+            continue
+
+        params = {
+            'id': venue_id,
+            'latitude': float(venue['latitude']),
+            'longitude': float(venue['longitude']),
+            'fetched_at': sa.func.now()
+        }
+        session.execute(
+            psql.insert(Venue)
+                .values(**params)
+                .on_conflict_do_update(
+                    index_elements=[Venue.id],
+                    set_=params))
+        venues[venue_id] = venue
 
-    return result
+    session.commit()
+    return venues
+
+
+@celery.task()
+def refresh_venues(venue_ids):
+    """Fetches venues again, ahead of their expiry."""
+    with session_scope() as db_session:
+        fetch_venues(venue_ids, db_session)
 
 
 def is_online(event, venue):
@@ -132,28 +287,127 @@ def load_event(event_params, session):
         event_params (dict): A set of event parameters.
         session (sa.scoped_session): A SQLAlchemy session.
     """
-    # Basic insert statement.
-    insert_stmt = psql.insert(Event).values(**event_params)
+    return load_events([event_params], session)
 
-    # Our ON CONFLICT DO UPDATE clause.
-    on_conflict_stmt = insert_stmt.on_conflict_do_update(
-        index_elements=[Event.id],
-        set_=event_params)
 
-    # Add to database.
-    session.execute(on_conflict_stmt)
-    session.commit()
+def content_hash(event_params):
+    """A digest of prepared event parameters that is stable across
+    runs. The location is left out, it comes from the same venue as
+    latitude and longitude.
+    """
+    values = {
+        k: v for k, v in event_params.items()
+        if k not in ('location', 'content_hash')
+    }
+    encoded = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def load_events(events_params, session):
+    """Loads events into the Events table, updating those that
+    exist. Each batch of EVENT_BATCH_SIZE events is one statement and
+    one commit.
+
+    Args:
+        events_params (list): Event parameters, as from `prepare_event`.
+            All must have the same keys.
+        session (sa.scoped_session): A SQLAlchemy session.
+
+    Returns:
+        A dict counting the events inserted, updated and unchanged.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    if not events_params:
+        return counts
+
+    # A statement can't update a row twice, keep the last of each id.
+    unique = [
+        e if 'content_hash' in e else dict(e, content_hash=content_hash(e))
+        for e in {e['id']: e for e in events_params}.values()
+    ]
+    counts['unchanged'] = len(events_params) - len(unique)
+
+    # Where changed events are now, and where moved ones were.
+    points = []
+    table = Event.__table__
+    for i in range(0, len(unique), config.EVENT_BATCH_SIZE):
+        batch = unique[i:i + config.EVENT_BATCH_SIZE]
+
+        previous = {
+            r.id: (r.latitude, r.longitude)
+            for r in session.execute(
+                sa.select([Event.id, Event.latitude, Event.longitude])
+                .where(Event.id.in_([e['id'] for e in batch])))
+        }
+
+        # Index the text for search in the VALUES rows, once per event.
+        insert_stmt = psql.insert(Event).values([
+            dict(e, search_vector=search_document(
+                e.get('title'), e.get('description_text')))
+            for e in batch
+        ])
+        excluded = insert_stmt.excluded
+        columns = list(batch[0]) + ['search_vector']
+
+        # Rewrite only rows whose data differs. xmax is 0 on rows this
+        # statement inserted; rows left alone are not returned.
+        stmt = (
+            insert_stmt.on_conflict_do_update(
+                index_elements=[Event.id],
+                set_={c: excluded[c] for c in columns if c != 'id'},
+                where=table.c.content_hash.is_distinct_from(
+                    excluded.content_hash))
+            .returning(
+                Event.id,
+                Event.latitude,
+                Event.longitude,
+                sa.literal_column('xmax = 0').label('inserted'))
+        )
+        rows = session.execute(stmt).fetchall()
+        session.commit()
+
+        inserted = sum(1 for r in rows if r.inserted)
+        counts['inserted'] += inserted
+        counts['updated'] += len(rows) - inserted
+        counts['unchanged'] += len(batch) - len(rows)
+        for r in rows:
+            points.append((r.latitude, r.longitude))
+            if r.id in previous:
+                points.append(previous[r.id])
+
+    # Expire cached /events responses around the events that changed.
+    if events_cache is not None:
+        events_cache.invalidate(
+            [p for p in points if p[0] is not None])
+    if counts['inserted'] or counts['updated']:
+        versions.bump(session, versions.EVENTS)
+
+    return counts
 
 
 @celery.task()
 def clear_old_events():
-    """Clear events whose end_time has passed."""
+    """Clear events whose end_time has passed, and rebuild the
+    upcoming-events index on today's date.
+    """
     cutoff = dt.date.today() - dt.timedelta(days=config.STALE_EVENT_DAYS)
     with session_scope() as db_session:
         stmt = (Event.__table__
                      .delete()
-                     .where(Event.end_time < cutoff))
-        db_session.execute(stmt)
+                     .where(Event.end_time < cutoff)
+                     .returning(Event.latitude, Event.longitude))
+        deleted = db_session.execute(stmt).fetchall()
+
+    if events_cache is not None:
+        events_cache.invalidate(
+            [(lat, lon) for lat, lon in deleted if lat is not None])
+
+    if deleted:
+        with session_scope() as db_session:
+            versions.bump(db_session, versions.EVENTS)
+
+    # Runs just after midnight, so the index moves on to the new day.
+    refresh_upcoming_index()
 
 
 @celery.task()
@@ -170,8 +424,7 @@ def update_categories(force=True):
 
     # Only do the update if we're empty or if we're forcing an update.
     if force or not any_categories:
-        eb = Eventbrite(config.EVENTBRITE_APP_KEY)
-        cat_response = eb.get_categories()
+        cat_response = fetch.call(fetch.get_categories)
 
         with session_scope() as db_session:
             for cat in cat_response['categories']:
@@ -185,10 +438,18 @@ def update_categories(force=True):
                             index_elements=[Category.category_id],
                             set_=params))
 
+        # Category names appear in /events results too. Cached
+        # responses are keyed by tile, so expire them all.
+        if events_cache is not None:
+            events_cache.invalidate_all()
+        with session_scope() as db_session:
+            versions.bump(
+                db_session, versions.CATEGORIES, versions.EVENTS)
+
 
 def prepare_event(event, venue):
     """Prepares an event for loading."""
-    return dict(
+    params = dict(
         id=event['id'],
         title=event['name']['text'],
         start_time=event['start']['utc'],
@@ -201,6 +462,8 @@ def prepare_event(event, venue):
             venue['longitude'],
             venue['latitude']
         )),
+        latitude=float(venue['latitude']),
+        longitude=float(venue['longitude']),
         logo=event['logo'],
         url=event['url'],
         description_text=event['description']['text'],
@@ -209,3 +472,5 @@ def prepare_event(event, venue):
         online_event=is_online(event, venue),
         category_id=event['category_id']
     )
+    params['content_hash'] = content_hash(params)
+    return params
@@ -15,3 +15,31 @@ EVENTBRITE_DATE_FMT_LOC = '%Y-%m-%dT%H:%M:%S'
 EVENTBRITE_EVENT_PAGES = int(os.environ.get('EVENTBRITE_EVENT_PAGES', 40))
 COLLECTION_INTERVAL = int(os.environ.get('COLLECTION_INTERVAL', 3600))  # sec
 STALE_EVENT_DAYS = int(os.environ.get('STALE_EVENT_DAYS', 5))
+
+# Venues are reused for VENUE_TTL, then for up to VENUE_STALE_TTL more
+# while a separate task refreshes them. Seconds.
+VENUE_TTL = int(os.environ.get('VENUE_TTL', 7 * 24 * 3600))
+VENUE_STALE_TTL = int(os.environ.get('VENUE_STALE_TTL', 30 * 24 * 3600))
+
+# Events upserted per statement (and commit) when loading.
+EVENT_BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', 500))
+
+# Eventbrite API access. Calls are budgeted per app key (shared through
+# Redis when EVENTBRITE_BUDGET_REDIS_URL is set), EVENTBRITE_CONCURRENCY
+# are in flight at once and failures are retried EVENTBRITE_RETRIES
+# times, backing off from EVENTBRITE_BACKOFF seconds.
+EVENTBRITE_API_URL = os.environ.get(
+    'EVENTBRITE_API_URL', 'https://www.eventbriteapi.com/v3/')
+EVENTBRITE_CALLS_PER_HOUR = int(os.environ.get('EVENTBRITE_CALLS_PER_HOUR', 2000))
+EVENTBRITE_BURST = int(os.environ.get('EVENTBRITE_BURST', 20))
+EVENTBRITE_BUDGET_REDIS_URL = os.environ.get(
+    'EVENTBRITE_BUDGET_REDIS_URL', celery_broker_url)
+EVENTBRITE_CONCURRENCY = int(os.environ.get('EVENTBRITE_CONCURRENCY', 8))
+EVENTBRITE_RETRIES = int(os.environ.get('EVENTBRITE_RETRIES', 4))
+EVENTBRITE_BACKOFF = float(os.environ.get('EVENTBRITE_BACKOFF', 1.0))  # sec
+EVENTBRITE_TIMEOUT = int(os.environ.get('EVENTBRITE_TIMEOUT', 30))  # sec
+
+# Retries of a failed page of event search results, backing off from
+# PAGE_RETRY_BACKOFF seconds.
+PAGE_RETRIES = int(os.environ.get('PAGE_RETRIES', 3))
+PAGE_RETRY_BACKOFF = int(os.environ.get('PAGE_RETRY_BACKOFF', 30))
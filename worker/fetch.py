@@ -0,0 +1,280 @@
+"""Concurrent Eventbrite requests within the API's rate budget.
+
+Eventbrite allows 2000 calls an hour per app key. Every call made here
+first takes a token from a bucket holding that budget, shared through
+Redis by all worker processes when EVENTBRITE_BUDGET_REDIS_URL is set.
+Up to EVENTBRITE_CONCURRENCY calls are in flight at once, and 429s, 5xxs
+and connection failures are retried with jittered exponential backoff.
+
+Requests go through a transport, so tests can answer them without a
+network:
+
+    client = EventbriteClient(key, FakeEventbrite(), budget)
+    pages = run(search_pages(client, data, 10))
+"""
+import asyncio
+import logging
+import random
+
+import aiohttp
+
+from beluga.ratelimit import MemoryBackend, RedisBackend
+from worker import config
+
+logger = logging.getLogger(__name__)
+
+
+class TransportError(Exception):
+    """A request got no HTTP response."""
+
+
+class FetchError(Exception):
+    """A request failed for good, or after all its retries."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class AiohttpTransport:
+    """Sends requests with one aiohttp session.
+
+    Args:
+        timeout (int): Seconds to wait for each response.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._session = None
+
+    async def get(self, url, params, headers):
+        """Returns (status, headers, decoded JSON body or None)."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        try:
+            async with self._session.get(
+                    url, params=params, headers=headers,
+                    timeout=self.timeout) as resp:
+                try:
+                    body = await resp.json(content_type=None)
+                except ValueError:
+                    body = None
+                return resp.status, resp.headers, body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise TransportError(str(e) or type(e).__name__)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class Budget:
+    """A token bucket over API calls, waited on rather than refused.
+
+    Args:
+        backend: A `beluga.ratelimit` MemoryBackend or RedisBackend.
+        rate (float): Calls allowed per second.
+        burst (int): Calls allowed at once after a quiet spell.
+        key (str): The bucket, shared by all users of the backend.
+    """
+
+    def __init__(self, backend, rate, burst, key='eventbrite'):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.key = key
+        self.taken = 0
+        self.waited = 0.0
+
+    async def take(self):
+        """Waits for a token."""
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.backend.blocking:
+                allowed, wait = await loop.run_in_executor(
+                    None, self.backend.take, self.key, self.rate, self.burst)
+            else:
+                allowed, wait = self.backend.take(
+                    self.key, self.rate, self.burst)
+            if allowed:
+                self.taken += 1
+                return
+            self.waited += wait
+            await asyncio.sleep(wait)
+
+
+def build_budget():
+    """The Eventbrite budget for this process."""
+    if config.EVENTBRITE_BUDGET_REDIS_URL:
+        backend = RedisBackend(
+            config.EVENTBRITE_BUDGET_REDIS_URL, prefix='beluga:budget:')
+    else:
+        backend = MemoryBackend(1)
+    return Budget(
+        backend,
+        config.EVENTBRITE_CALLS_PER_HOUR / 3600.0,
+        config.EVENTBRITE_BURST)
+
+
+budget = build_budget()
+
+
+class EventbriteClient:
+    """Eventbrite API calls over a transport, within a budget.
+
+    Args:
+        token (str): The Eventbrite app key.
+        transport: Has `async get(url, params, headers)` returning
+            (status, headers, body), and `async close()`.
+        budget (Budget): Charged one token per call, retries included.
+        concurrency (int): Calls in flight at once.
+        retries (int): Extra attempts after a 429, 5xx or no response.
+        backoff (float): Upper bound, in seconds, of the first retry's
+            delay. It doubles with every attempt, up to `max_backoff`.
+    """
+
+    def __init__(self, token, transport, budget, concurrency=8, retries=4,
+                 backoff=1.0, max_backoff=60.0, url=None):
+        self.token = token
+        self.transport = transport
+        self.budget = budget
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.url = (url or config.EVENTBRITE_API_URL).rstrip('/')
+        self._slots = asyncio.Semaphore(concurrency)
+        self.calls = 0
+        self.retried = 0
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (from 0): a
+        random point below the doubled backoff, and no sooner than the
+        server asked.
+        """
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        try:
+            return max(delay, float(retry_after or 0))
+        except ValueError:
+            return delay
+
+    async def get(self, path, **params):
+        """Returns the decoded body of a GET to `path`.
+
+        Raises:
+            FetchError: On a 4xx other than 429, or once retries run out.
+        """
+        params = {k: str(v) for k, v in params.items()}
+        params.setdefault('expand', 'none')
+        headers = {'Authorization': 'Bearer {}'.format(self.token)}
+
+        for attempt in range(self.retries + 1):
+            async with self._slots:
+                await self.budget.take()
+                self.calls += 1
+                try:
+                    status, resp_headers, body = await self.transport.get(
+                        self.url + path, params, headers)
+                except TransportError as e:
+                    status, resp_headers, body = None, {}, str(e)
+
+            if status == 200:
+                return body
+            if status is not None and status != 429 and status < 500:
+                raise FetchError('GET {} returned {}'.format(path, status),
+                                 status)
+            if attempt == self.retries:
+                break
+
+            self.retried += 1
+            delay = self.delay(attempt, resp_headers.get('Retry-After'))
+            logger.info('Retrying GET {} in {:.1f}s after {}'.format(
+                path, delay, status or body))
+            await asyncio.sleep(delay)
+
+        raise FetchError(
+            'GET {} failed after {} attempts'.format(path, attempt + 1),
+            status)
+
+    async def close(self):
+        await self.transport.close()
+
+
+def connect(transport=None):
+    """A client with the configured key, limits and transport."""
+    return EventbriteClient(
+        config.EVENTBRITE_APP_KEY,
+        transport or AiohttpTransport(config.EVENTBRITE_TIMEOUT),
+        budget,
+        concurrency=config.EVENTBRITE_CONCURRENCY,
+        retries=config.EVENTBRITE_RETRIES,
+        backoff=config.EVENTBRITE_BACKOFF)
+
+
+def run(coro):
+    """Runs a coroutine to completion from synchronous (task) code."""
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def call(fetcher, *args):
+    """Runs `fetcher(client, *args)`, one of the functions below, with
+    a new client. For synchronous (task) code.
+    """
+    async def with_client():
+        client = connect()
+        try:
+            return await fetcher(client, *args)
+        finally:
+            await client.close()
+    return run(with_client())
+
+
+async def search_page(client, data, page):
+    """Fetches one page of an event search."""
+    return await client.get('/events/search/', page=page, **data)
+
+
+async def search_pages(client, data, max_pages):
+    """Fetches up to `max_pages` pages of an event search. The first
+    page gives the page count; the rest are fetched concurrently.
+
+    Returns:
+        The search responses, in page order.
+    """
+    first = await client.get('/events/search/', page=1, **data)
+    to_collect = min(first['pagination']['page_count'], max_pages)
+    rest = await asyncio.gather(*[
+        client.get('/events/search/', page=page, **data)
+        for page in range(2, to_collect + 1)
+    ])
+    return [first] + list(rest)
+
+
+async def get_venues(client, venue_ids):
+    """Fetches venues concurrently. Venues that can't be fetched are
+    logged and left out.
+
+    Returns:
+        A dict of venue id to venue.
+    """
+    venue_ids = list(venue_ids)
+    results = await asyncio.gather(*[
+        client.get('/venues/{}/'.format(venue_id)) for venue_id in venue_ids
+    ], return_exceptions=True)
+
+    venues = {}
+    for venue_id, result in zip(venue_ids, results):
+        if isinstance(result, FetchError):
+            logger.warning('Could not fetch venue {}: {}'.format(
+                venue_id, result))
+        elif isinstance(result, Exception):
+            raise result
+        else:
+            venues[venue_id] = result
+    return venues
+
+
+async def get_categories(client):
+    """Fetches all Eventbrite categories."""
+    return await client.get('/categories/')